@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+'''
+Tick latency of the serial and threaded collectors, with all the targets available on the local machine.
+
+Usage: python benchmarks/bench_collection.py [--ticks 200] [--interval 0.05] [--timeout 0.5]
+'''
+import argparse
+import sys
+import time
+from ratatouille.ratatouille import monitor_classes, SerialCollector, ThreadedCollector, RatatouillePortabilityError
+from ratatouille.ratatouille import RatatouilleDependencyError
+
+
+def tick_latencies(collector, nb_ticks, interval):
+    latencies = []
+    for _ in range(nb_ticks):
+        start = time.perf_counter()
+        collector.collect()
+        latencies.append(time.perf_counter() - start)
+        time.sleep(interval)
+    collector.close()
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the serial and threaded collectors')
+    parser.add_argument('--ticks', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.05)
+    parser.add_argument('--timeout', type=float, default=None)
+    args = parser.parse_args()
+    watchers = []
+    for name, cls in monitor_classes.items():
+        try:
+            watchers.append(cls())
+        except (RatatouillePortabilityError, RatatouilleDependencyError) as e:
+            sys.stderr.write('WARNING: %s\n' % e)
+    print('targets: %s' % ', '.join(type(w).__name__ for w in watchers))
+    collectors = {
+        'serial': SerialCollector(watchers),
+        'threaded': ThreadedCollector(watchers, timeout=args.timeout),
+    }
+    print('%10s %12s %12s %12s %12s' % ('collector', 'mean (ms)', 'median (ms)', 'p99 (ms)', 'max (ms)'))
+    for name, collector in collectors.items():
+        lat = tick_latencies(collector, args.ticks, args.interval)
+        print('%10s %12.3f %12.3f %12.3f %12.3f' % (name, sum(lat)/len(lat)*1e3, lat[len(lat)//2]*1e3,
+                                                   lat[int(len(lat)*0.99)]*1e3, lat[-1]*1e3))
+
+
+if __name__ == '__main__':
+    main()
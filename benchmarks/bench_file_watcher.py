@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+'''
+Per-sample cost of FileWatcher as a function of the number of cores, with and without persistent file handles.
+The cpufreq files are faked in a temporary directory, so the core counts do not depend on the local machine.
+
+Usage: python benchmarks/bench_file_watcher.py [--cores 1 16 64 256 1024] [--samples 1000]
+'''
+import argparse
+import tempfile
+import time
+from ratatouille.fake import make_cpufreq_tree
+from ratatouille.ratatouille import FileWatcher
+
+
+def time_per_sample(watcher, nb_samples):
+    start = time.perf_counter()
+    for _ in range(nb_samples):
+        watcher.get_values()
+    return (time.perf_counter() - start) / nb_samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the FileWatcher sampling cost')
+    parser.add_argument('--cores', type=int, nargs='+', default=[1, 16, 64, 256, 1024])
+    parser.add_argument('--samples', type=int, default=1000)
+    args = parser.parse_args()
+    print('%8s %16s %16s %8s' % ('cores', 'open (us)', 'persistent (us)', 'speedup'))
+    for nb_cores in args.cores:
+        with tempfile.TemporaryDirectory() as root:
+            make_cpufreq_tree(root, nb_cores)
+            durations = []
+            for persistent in [False, True]:
+                watcher = FileWatcher(root, 'cpu', 'cpufreq/scaling_cur_freq', persistent=persistent)
+                durations.append(time_per_sample(watcher, args.samples))
+                watcher.close()
+        print('%8d %16.1f %16.1f %8.1f' % (nb_cores, durations[0]*1e6, durations[1]*1e6, durations[0]/durations[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+'''
+Duration and peak memory of the merge of many synthetic traces, the nodes having different numbers of cores.
+Each configuration is run in a separate process, so that the peak memory usages are not mixed.
+
+Usage: python benchmarks/bench_merge.py [--files 100] [--rows 5000] [--jobs 1 4]
+'''
+import argparse
+import datetime
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+from ratatouille.ratatouille import merge_files
+
+
+def make_trace(filename, hostname, nb_rows, nb_cores):
+    start = datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=random.random())
+    with open(filename, 'w') as f:
+        columns = ['hostname', 'timestamp', 'cpu_load'] + ['frequency_core_%d' % i for i in range(nb_cores)]
+        f.write(','.join(columns) + '\n')
+        for i in range(nb_rows):
+            timestamp = start + datetime.timedelta(seconds=i)
+            values = [hostname, str(timestamp), '%.1f' % (random.random()*100)]
+            values.extend(str(random.randint(1000000000, 3000000000)) for _ in range(nb_cores))
+            f.write(','.join(values) + '\n')
+
+
+def run_merge(filenames, output, jobs, result):
+    start = time.perf_counter()
+    merge_files(filenames, output, jobs=jobs)
+    result.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def run_pandas(filenames, output, jobs, result):
+    import pandas
+    start = time.perf_counter()
+    pandas.concat([pandas.read_csv(f) for f in filenames], sort=False).to_csv(output, index=False)
+    result.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the merge of many traces')
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--pandas', action='store_true', help='Also run the in-memory merge with pandas.')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filenames = []
+        for i in range(args.files):
+            filenames.append(os.path.join(tmpdir, 'node_%d.csv' % i))
+            make_trace(filenames[-1], 'node_%d' % i, args.rows, random.choice([8, 16, 32]))
+        size = sum(os.path.getsize(f) for f in filenames)
+        print('%d files, %d rows each, %.1f MB in total' % (args.files, args.rows, size*1e-6))
+        configs = [('streaming, %d jobs' % jobs, run_merge, jobs) for jobs in args.jobs]
+        if args.pandas:
+            configs.append(('pandas.concat', run_pandas, 1))
+        print('%20s %12s %16s' % ('merge', 'time (s)', 'peak RSS (MB)'))
+        for name, func, jobs in configs:
+            result = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=func, args=(filenames, os.path.join(tmpdir, 'out.csv'), jobs, result))
+            proc.start()
+            duration, maxrss = result.get()
+            proc.join()
+            print('%20s %12.2f %16.1f' % (name, duration, maxrss*1e-3))
+
+
+if __name__ == '__main__':
+    main()
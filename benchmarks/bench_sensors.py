@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+'''
+Per-tick cost of the Temperature watcher on fake coretemp hwmon trees, comparing:
+    - rebuild: what was done at each tick before the sensor plans, i.e. finding and reading all the sensors (as
+      psutil.sensors_temperatures does), then parsing the labels and building the dictionary of all the columns
+    - plan: reading only the input files of the plan built at construction
+    - plan (persistent): same, the input files being kept open
+
+Usage: python benchmarks/bench_sensors.py [--packages 1 2 4 8] [--cores 32] [--samples 200]
+'''
+import argparse
+import tempfile
+import time
+from ratatouille.fake import make_hwmon_tree
+from ratatouille.ratatouille import Temperature, HwmonSensor, discover_hwmon, get_string_in_file
+
+
+def rebuild(root, header):
+    sensors = discover_hwmon(root, 'temp')
+    temperatures = {unit: [HwmonSensor(s.label, int(get_string_in_file(s.current))/1000) for s in unit_sensors]
+                    for unit, unit_sensors in sensors.items()}
+    values = Temperature._build_columns(temperatures)
+    return [values[k] for k in header]
+
+
+def time_per_tick(func, nb_samples):
+    start = time.perf_counter()
+    for _ in range(nb_samples):
+        func()
+    return (time.perf_counter() - start) / nb_samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the Temperature watcher')
+    parser.add_argument('--packages', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--cores', type=int, default=32, help='Number of cores per package.')
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args()
+    print('%8s %8s %14s %14s %20s %8s' % ('packages', 'sensors', 'rebuild (us)', 'plan (us)', 'plan persistent (us)',
+                                          'speedup'))
+    for nb_packages in args.packages:
+        with tempfile.TemporaryDirectory() as root:
+            make_hwmon_tree(root, nb_packages, nb_packages*args.cores)
+            temp = Temperature(hwmon_root=root)
+            persistent = Temperature(hwmon_root=root, persistent=True)
+            assert rebuild(root, temp.header) == temp.get_values() == persistent.get_values()
+            durations = [
+                time_per_tick(lambda: rebuild(root, temp.header), args.samples),
+                time_per_tick(temp.get_values, args.samples),
+                time_per_tick(persistent.get_values, args.samples),
+            ]
+            persistent.close()
+        print('%8d %8d %14.1f %14.1f %20.1f %8.1f' % (nb_packages, len(temp.header), *[d*1e6 for d in durations],
+                                                      durations[0]/durations[2]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+'''
+Time from the invocation of ratatouille to its first measure, when wrapping a short command:
+    - collect: the collector started in the background, as done by tools/do_collect.sh (the first measure happens
+      after a whole period)
+    - run (cold): "ratatouille run", without any discovery cache
+    - run (warm): "ratatouille run", the sysfs files found by a previous run being reused
+The instant of the first measure is taken from the first timestamp of the output file.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--interval 1]
+'''
+import argparse
+import csv
+import datetime
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def first_timestamp(filename):
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        return datetime.datetime.fromisoformat(next(reader)[header.index('timestamp')])
+
+
+def time_to_first_sample(args, output, env, interrupt_after=None):
+    start = datetime.datetime.now()
+    proc = subprocess.Popen([sys.executable, '-m', 'ratatouille'] + args, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    if interrupt_after is not None:
+        time.sleep(interrupt_after)
+        proc.send_signal(signal.SIGINT)
+    proc.wait()
+    return (first_timestamp(output) - start).total_seconds()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the startup of ratatouille')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=1)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, 'out.csv')
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, 'cache'))
+        run_args = ['run', '-t', str(args.interval), output, '--', 'true']
+        durations = {'collect': [], 'run (cold)': [], 'run (warm)': []}
+        # fill the discovery cache
+        subprocess.run([sys.executable, '-m', 'ratatouille'] + run_args, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        for _ in range(args.runs):
+            durations['collect'].append(time_to_first_sample(
+                ['collect', '-t', str(args.interval), 'all', output], output, env,
+                interrupt_after=args.interval + 1))
+            cold_env = dict(env, XDG_CACHE_HOME=tempfile.mkdtemp(dir=tmpdir))
+            durations['run (cold)'].append(time_to_first_sample(run_args, output, cold_env))
+            durations['run (warm)'].append(time_to_first_sample(run_args, output, env))
+    print('%12s %18s %18s' % ('command', 'median (ms)', 'min (ms)'))
+    for name, values in durations.items():
+        values.sort()
+        print('%12s %18.1f %18.1f' % (name, values[len(values)//2]*1e3, values[0]*1e3))
+
+
+if __name__ == '__main__':
+    main()
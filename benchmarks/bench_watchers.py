@@ -0,0 +1,74 @@
+'''
+Cost of collecting each target on fake machines (see ratatouille.fake) of 16 to 1024 cores, with 4 packages (i.e. 16
+RAPL domains):
+- test_watch times Monitor.watch alone, the measures following each other without pacing, with the sysfs files opened
+  at each measure or kept open between two measures (the persistent parameter, as done by "collect --high_rate"). The
+  fraction of a core that a period of 1 second or of 10 milliseconds would use is extrapolated from the mean cost of a
+  measure, as extra information (extrapolated_core_fraction_1s and extrapolated_core_fraction_10ms).
+- test_sustained_rate runs the loop of a Monitor for a second at a period of 10 milliseconds, with the files kept open,
+  so the scheduler and the writer are included: the rate achieved (in measures per second), the number of measures
+  skipped and the fraction of a core used by the loop (its CPU time divided by the duration) are given as extra
+  information.
+
+This file is a pytest-benchmark suite, skipped if the plugin is not installed:
+    python -m pytest benchmarks/bench_watchers.py --benchmark-group-by=param:target --benchmark-columns=mean,stddev
+'''
+import functools
+import threading
+import time
+import pytest
+pytest.importorskip('pytest_benchmark')
+from ratatouille.fake import FakeSystem
+from ratatouille.ratatouille import Monitor
+from ratatouille.storage import RingBufferWriter
+
+
+@pytest.fixture(scope='module')
+def fake_systems(tmp_path_factory):
+    systems = {}
+
+    def get(nb_cores):
+        if nb_cores not in systems:
+            root = str(tmp_path_factory.mktemp('fake_%d_cores' % nb_cores))
+            systems[nb_cores] = FakeSystem(root, nb_cores=nb_cores, nb_packages=4)
+        return systems[nb_cores]
+    yield get
+    for system in systems.values():
+        system.close()
+
+
+@pytest.mark.parametrize('persistent', [False, True])
+@pytest.mark.parametrize('nb_cores', [16, 256, 1024])
+@pytest.mark.parametrize('target', FakeSystem.targets)
+def test_watch(benchmark, fake_systems, target, nb_cores, persistent):
+    watcher = fake_systems(nb_cores).create_watcher(target, persistent=persistent)
+    monitor = Monitor([watcher], None, 1, output_format=functools.partial(RingBufferWriter, 1000),
+                      handle_signals=False)
+    benchmark(monitor.watch)
+    # the stats are not computed with --benchmark-disable
+    if benchmark.stats:
+        for name, period in [('1s', 1), ('10ms', 0.01)]:
+            benchmark.extra_info['extrapolated_core_fraction_%s' % name] = benchmark.stats.stats.mean / period
+    watcher.close()
+
+
+@pytest.mark.parametrize('nb_cores', [16, 256, 1024])
+@pytest.mark.parametrize('target', FakeSystem.targets)
+def test_sustained_rate(benchmark, fake_systems, target, nb_cores, period=0.01, duration=1):
+    watcher = fake_systems(nb_cores).create_watcher(target, persistent=True)
+    monitor = Monitor([watcher], None, period, output_format=functools.partial(RingBufferWriter, 1000),
+                      handle_signals=False)
+
+    def run():
+        # the loop runs in this thread, so its CPU time is the one of the thread
+        timer = threading.Timer(duration, monitor.stop)
+        timer.start()
+        start, cpu_start = time.monotonic(), time.thread_time()
+        monitor.start_loop()
+        timer.join()
+        return time.monotonic() - start, time.thread_time() - cpu_start
+    elapsed, cpu_time = benchmark.pedantic(run, rounds=1, iterations=1)
+    benchmark.extra_info['achieved_rate'] = monitor.writer.nb_rows / elapsed
+    benchmark.extra_info['skipped'] = monitor.scheduler.nb_skipped
+    benchmark.extra_info['core_fraction'] = cpu_time / elapsed
+    watcher.close()
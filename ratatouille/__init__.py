@@ -1,3 +1,4 @@
 from .version import __version__, __git_version__
+from .ratatouille import Sampler
 
-__all__ = ['__version__', '__git_version__']
+__all__ = ['__version__', '__git_version__', 'Sampler']
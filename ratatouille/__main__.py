@@ -1,11 +1,85 @@
 import argparse
+import subprocess
+import threading
 import time
 import sys
-from .ratatouille import Monitor, Drawer, monitor_classes, merge_files, RatatouilleDependencyError
-from .ratatouille import RatatouillePortabilityError
+from collections import OrderedDict
+from .ratatouille import Monitor, Drawer, monitor_classes, merge_files, selfbench, RatatouilleDependencyError
+from .ratatouille import RatatouillePortabilityError, ProcFS, ChildTimes, BurstPolicy, enable_discovery_cache
+from .ratatouille import ProcessTree
+from .storage import trace_writers, compressions, open_output_file, index_filename
 from .version import __version__, __git_version__
 
 
+def parse_rates(string):
+    rates = {}
+    for item in string.split(','):
+        try:
+            target, period = item.split('=')
+            period = float(period)
+        except ValueError:
+            raise argparse.ArgumentTypeError('expected a list of target=period, got "%s"' % string)
+        if target not in monitor_classes:
+            raise argparse.ArgumentTypeError('unknown target "%s"' % target)
+        rates[target] = period
+    return rates
+
+
+def parse_targets(string):
+    targets = string.split(',')
+    for target in targets:
+        if target not in monitor_classes and target != 'all':
+            raise argparse.ArgumentTypeError('unknown target "%s"' % target)
+    return targets
+
+
+def create_watchers(targets, high_rate=False, proc=None, arguments=None):
+    '''
+    Return the list of the (target, watcher) for the given targets that are available, warning about the others.
+    The optional arguments map targets to keyword arguments of their watcher (e.g. the path of a cgroup), the errors
+    of these targets being raised instead of warned about.
+    '''
+    arguments = {} if arguments is None else arguments
+    watchers = []
+    for target in targets:
+        mon = monitor_classes[target]
+        kwargs = dict(arguments.get(target, {}))
+        if high_rate and mon.supports_persistent_files:
+            kwargs['persistent'] = True
+        if proc is not None and mon.supports_proc:
+            kwargs['proc'] = proc
+        try:
+            watchers.append((target, mon(**kwargs)))
+        except (RatatouillePortabilityError, RatatouilleDependencyError) as e:
+            if target in arguments:
+                raise
+            sys.stderr.write('WARNING: %s\n' % e)
+    return watchers
+
+
+def add_burst_arguments(parser):
+    parser.add_argument('--burst', action='append', default=[], metavar='RULE',
+                        help='Write the measures every --burst_interval seconds while this rule is met, e.g. '
+                        '"temperature_cpu_0>90", "change(power_package-0)>20" or "drop(frequency_core_*)>1e8" '
+                        '(can be repeated).')
+    parser.add_argument('--burst_interval', type=float, default=0.1,
+                        help='Period of the measures during a burst, in seconds.')
+    parser.add_argument('--burst_hold', type=int, default=10,
+                        help='Number of measures at the burst interval after the rules stop being met.')
+    parser.add_argument('--burst_decay', type=float, default=2,
+                        help='Factor by which the period then grows at each measure, back to the base period.')
+    parser.add_argument('--pre_trigger', type=int, default=0,
+                        help='Measure at the burst interval all the time, keeping this number of measures in '
+                        'memory to write them when a burst starts.')
+
+
+def create_burst_policy(args):
+    if len(args.burst) == 0:
+        return None
+    return BurstPolicy(args.burst, interval=args.burst_interval, hold=args.burst_hold, decay=args.burst_decay,
+                       pre_trigger=args.pre_trigger)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Monitoring of the system resources')
@@ -16,56 +90,294 @@ def main():
     sp = parser.add_subparsers(dest='command')
     sp.required = True
     sp_collect = sp.add_parser('collect', help='Collect system data.')
-    sp_collect.add_argument('--time_interval', '-t', type=int, default=60,
+    sp_collect.add_argument('--time_interval', '-t', type=float, default=60,
                             help='Period of the measures, in seconds.')
+    sp_collect.add_argument('--high_rate', action='store_true',
+                            help='Keep the sysfs files open between two measures (recommended for sub-second periods).')
+    sp_collect.add_argument('--catch_up', action='store_true',
+                            help='Run the missed measures as soon as possible instead of skipping them.')
+    sp_collect.add_argument('--parallel', action='store_true',
+                            help='Collect the values of all the targets concurrently, in separate threads.')
+    sp_collect.add_argument('--watcher_timeout', type=float, default=None,
+                            help='Time (in seconds) after which a target is given NaN values for the measure '
+                            '(implies --parallel).')
+    sp_collect.add_argument('--rates', type=parse_rates, default={},
+                            help='Specific periods (in seconds) for some targets, e.g. "cpu_freq=0.1,temperature=5". '
+                            'The output is then written in long format.')
+    sp_collect.add_argument('--format', choices=list(trace_writers), default='csv',
+                            help='Format of the output file (csv_delta only writes the values that changed).')
+    sp_collect.add_argument('--compression', choices=['auto'] + list(compressions), default=None,
+                            help='Compress the output file (CSV formats only), "auto" choosing zstd or lz4 if '
+                            'installed and gzip otherwise.')
+    sp_collect.add_argument('--flush_rows', type=int, default=None,
+                            help='Buffer the rows in memory and write them by batches of this size.')
+    sp_collect.add_argument('--flush_interval', type=float, default=None,
+                            help='Buffer the rows in memory and write them at least every this number of seconds.')
+    sp_collect.add_argument('--fsync', action='store_true',
+                            help='Synchronize the output file to the disk after each batch of rows.')
+    sp_collect.add_argument('--background_io', action='store_true',
+                            help='Write the batches of rows in a separate thread.')
+    sp_collect.add_argument('--instrument', action='store_true',
+                            help='Add the CPU time and memory usage of the collector to the rows and print statistics '
+                            'on each target when stopping.')
+    sp_collect.add_argument('--proc_backend', action='store_true',
+                            help='Read /proc directly, each file once per measure, instead of using psutil (Linux).')
+    sp_collect.add_argument('--summary', type=float, default=None, metavar='WINDOW',
+                            help='Only write the min, mean, max and 99th percentile of each column over windows of '
+                            'this duration (in seconds), in long format.')
+    sp_collect.add_argument('--cgroup', type=str, default=None,
+                            help='Collect the resource usage of this cgroup (v2), e.g. "/user.slice/job_42", with '
+                            'the cgroup target (added if needed) instead of the cgroup of the collector.')
+    sp_collect.add_argument('--pid', type=int, default=None,
+                            help='Collect the resource usage of this process and of its descendants, with the '
+                            'process_tree target (added if needed) instead of the collector process.')
+    sp_collect.add_argument('--index_rows', type=int, default=1000,
+                            help='Write the timestamp and offset of one row every this number of rows in a sidecar '
+                            'file (CSV format, uncompressed), to plot or merge time ranges quickly (0 to disable).')
+    add_burst_arguments(sp_collect)
     sp_collect.add_argument('targets', nargs='+', help='what to collect', choices=list(monitor_classes) + ['all'])
-    sp_collect.add_argument('output_file', type=argparse.FileType('w'),
+    sp_collect.add_argument('output_file', type=str,
+                            help='Output file for the measures, or address of an aggregator (tcp://host:port) to '
+                            'which they are sent in binary format.')
+    sp_collect = sp.add_parser('run', help='Run a command while collecting system data.')
+    sp_collect.add_argument('--time_interval', '-t', type=float, default=1,
+                            help='Period of the measures, in seconds.')
+    sp_collect.add_argument('--targets', type=parse_targets, default=['all'],
+                            help='Comma-separated list of the targets to collect (default: all).')
+    sp_collect.add_argument('--high_rate', action='store_true',
+                            help='Keep the sysfs files open between two measures (recommended for sub-second periods).')
+    sp_collect.add_argument('--proc_backend', action='store_true',
+                            help='Read /proc directly, each file once per measure, instead of using psutil (Linux).')
+    sp_collect.add_argument('--format', choices=list(trace_writers), default='csv',
+                            help='Format of the output file.')
+    sp_collect.add_argument('--compression', choices=['auto'] + list(compressions), default=None,
+                            help='Compress the output file (CSV formats only).')
+    sp_collect.add_argument('--no_discovery_cache', action='store_true',
+                            help='Do not reuse the sysfs files found by the previous runs.')
+    add_burst_arguments(sp_collect)
+    sp_collect.add_argument('output_file', type=str,
                             help='Output file for the measures.')
+    sp_collect.add_argument('cmd', nargs=argparse.REMAINDER, metavar='-- command',
+                            help='Command to run.')
+    sp_collect = sp.add_parser('serve', help='Aggregate the measures sent by several collectors.')
+    sp_collect.add_argument('--host', type=str, default='0.0.0.0',
+                            help='Address on which the connections are accepted.')
+    sp_collect.add_argument('--port', '-p', type=int, default=5555,
+                            help='Port on which the connections are accepted.')
+    sp_collect.add_argument('--max_delay', type=float, default=10,
+                            help='Time (in seconds) after which a silent collector is not waited for anymore to '
+                            'write the rows in order.')
+    sp_collect.add_argument('--format', choices=[fmt for fmt in trace_writers if fmt != 'binary'], default='csv',
+                            help='Format of the output file.')
+    sp_collect.add_argument('--compression', choices=['auto'] + list(compressions), default=None,
+                            help='Compress the output file.')
+    sp_collect.add_argument('output_file', type=str,
+                            help='Output file for the measures of all the collectors, in long format.')
+    sp_collect = sp.add_parser('selfbench', help='Measure the overhead of the collection of each target.')
+    sp_collect.add_argument('--nb_samples', '-n', type=int, default=100,
+                            help='Number of samples of each target.')
+    sp_collect.add_argument('--time_interval', '-t', type=float, default=0.01,
+                            help='Period of the samples, in seconds.')
+    sp_collect.add_argument('--high_rate', action='store_true',
+                            help='Keep the sysfs files open between two samples.')
+    sp_collect.add_argument('--proc_backend', action='store_true',
+                            help='Read /proc directly instead of using psutil (Linux).')
+    sp_collect.add_argument('targets', nargs='*', help='what to measure (default: all), among %s' %
+                            ', '.join(monitor_classes))
     sp_collect = sp.add_parser('plot', help='Plot the collected data.')
-    sp_collect.add_argument('input_file', type=argparse.FileType('r'),
+    sp_collect.add_argument('input_file', type=str,
                             help='Input file of the measures.')
     sp_collect.add_argument('--output', '-o', type=str,
                             help='Output file of the plot.')
+    sp_collect.add_argument('--start', type=str, default=None,
+                            help='Only plot the data after this date (e.g. "2020-01-01 12:00").')
+    sp_collect.add_argument('--end', type=str, default=None,
+                            help='Only plot the data before this date.')
+    sp_collect.add_argument('--no_cache', action='store_true',
+                            help='Do not keep the parsed CSV columns in a sidecar binary file.')
+    sp_collect.add_argument('--max_points', type=int, default=None,
+                            help='Number of time buckets per column (default: one per pixel, 0 to plot all the rows).')
     sp_collect.add_argument('column_name', type=str, nargs='*',
                             help='Columns to plot.')
-    sp_collect = sp.add_parser('merge', help='Merge the given CSV files.')
-    sp_collect.add_argument('input_file', type=argparse.FileType('r'), nargs='+',
+    sp_collect = sp.add_parser('merge', help='Merge the given files.')
+    sp_collect.add_argument('--format', choices=list(trace_writers), default='csv',
+                            help='Format of the output file.')
+    sp_collect.add_argument('--compression', choices=['auto'] + list(compressions), default=None,
+                            help='Compress the output file (CSV formats only).')
+    sp_collect.add_argument('--jobs', '-j', type=int, default=1,
+                            help='Number of input files read in parallel.')
+    sp_collect.add_argument('--start', type=str, default=None,
+                            help='Only merge the data after this date (e.g. "2020-01-01 12:00").')
+    sp_collect.add_argument('--end', type=str, default=None,
+                            help='Only merge the data before this date.')
+    sp_collect.add_argument('input_file', type=str, nargs='+',
                             help='Input files to merge.')
     sp_collect.add_argument('output_file', type=str,
                             help='Output file to store the merged data.')
     args = parser.parse_args(sys.argv[1:])
     if args.command == 'collect':
         if 'all' in args.targets:
-            to_monitor = monitor_classes.values()
+            to_monitor = list(monitor_classes)
         else:
-            to_monitor = set()
-            for target in args.targets:
-                to_monitor.add(monitor_classes[target])
-        instances = []
-        for mon in to_monitor:
-            try:
-                instances.append(mon())
-            except RatatouillePortabilityError as e:
-                sys.stderr.write('WARNING: %s\n' % e)
-        monitor = Monitor([inst for inst in instances], time_interval=args.time_interval,
-                          output_file=args.output_file)
+            to_monitor = list(OrderedDict.fromkeys(args.targets))
+        for target in args.rates:
+            if target not in to_monitor:
+                parser.error('target %s has a specific period but is not collected' % target)
+        arguments = {}
+        if args.cgroup is not None:
+            arguments['cgroup'] = {'path': args.cgroup}
+        if args.pid is not None:
+            arguments['process_tree'] = {'pid': args.pid}
+        to_monitor.extend(target for target in arguments if target not in to_monitor)
+        proc = ProcFS() if args.proc_backend else None
+        try:
+            watchers = create_watchers(to_monitor, high_rate=args.high_rate, proc=proc, arguments=arguments)
+        except (RatatouillePortabilityError, RatatouilleDependencyError) as e:
+            parser.error(str(e))
+        instances = [inst for _, inst in watchers]
+        periods = [args.rates.get(target) for target, _ in watchers]
+        flush_rows = args.flush_rows
+        if args.output_file.startswith('tcp://'):
+            if args.compression is not None or args.fsync:
+                parser.error('the measures sent to an aggregator cannot be compressed or synced')
+            args.format = 'binary'
+            if flush_rows is None and args.flush_interval is None:
+                # send each row as soon as it is collected
+                flush_rows = 1
+        try:
+            if args.output_file.startswith('tcp://'):
+                from .aggregator import connect_sink
+                output_file = connect_sink(args.output_file)
+            else:
+                output_file = open_output_file(args.output_file, args.format, args.compression)
+            index_file = None
+            if args.format == 'csv' and args.compression is None and args.index_rows > 0 and \
+                    not args.output_file.startswith('tcp://'):
+                index_file = open(index_filename(args.output_file), 'w', newline='')
+        except (ValueError, ImportError, OSError) as e:
+            parser.error(str(e))
+        try:
+            monitor = Monitor([inst for inst in instances], time_interval=args.time_interval, periods=periods,
+                              output_file=output_file, output_format=args.format, catch_up=args.catch_up,
+                              parallel=args.parallel or args.watcher_timeout is not None,
+                              watcher_timeout=args.watcher_timeout, flush_rows=flush_rows,
+                              flush_interval=args.flush_interval, fsync=args.fsync, background_io=args.background_io,
+                              instrument=args.instrument, summary_window=args.summary,
+                              burst=create_burst_policy(args), index_file=index_file, index_rows=args.index_rows)
+        except ValueError as e:
+            parser.error(str(e))
         t = time.time()
         monitor.start_loop()
         t = time.time() - t
+        for inst in instances:
+            inst.close()
+        if proc is not None:
+            proc.close()
+        output_file.close()
+        if index_file is not None:
+            index_file.close()
         print('Monitored the sytem for %d seconds' % int(t))
+        if monitor.burst is not None:
+            print('Number of bursts: %d' % monitor.burst.nb_bursts)
+        if monitor.scheduler.nb_skipped > 0:
+            sys.stderr.write('WARNING: %d measures were skipped, the collection was too slow for the period\n' %
+                             monitor.scheduler.nb_skipped)
+    elif args.command == 'run':
+        command = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+        if len(command) == 0:
+            parser.error('no command to run')
+        to_monitor = list(monitor_classes) if 'all' in args.targets else list(OrderedDict.fromkeys(args.targets))
+        cache = None if args.no_discovery_cache else enable_discovery_cache()
+        proc = ProcFS() if args.proc_backend else None
+        instances = [inst for _, inst in create_watchers(to_monitor, high_rate=args.high_rate, proc=proc)]
+        if cache is not None:
+            cache.save()
+        try:
+            output_file = open_output_file(args.output_file, args.format, args.compression)
+        except (ValueError, ImportError) as e:
+            parser.error(str(e))
+        child = ChildTimes()
+        try:
+            monitor = Monitor(instances + [child], time_interval=args.time_interval, output_file=output_file,
+                              output_format=args.format, burst=create_burst_policy(args))
+        except ValueError as e:
+            parser.error(str(e))
+        # baseline measure, before the command starts
+        monitor.watch()
+        child.mark_start()
+        try:
+            process = subprocess.Popen(command)
+        except OSError as e:
+            process = None
+            sys.stderr.write('ERROR: cannot run %s: %s\n' % (command[0], e))
+            monitor.stop()
+        else:
+            # the process_tree target follows the command, not the collector
+            for inst in instances:
+                if isinstance(inst, ProcessTree):
+                    try:
+                        inst.set_root(process.pid)
+                    except RatatouillePortabilityError:
+                        pass
+            def wait_child():
+                process.wait()
+                child.mark_exit()
+                monitor.stop()
+            waiter = threading.Thread(target=wait_child, daemon=True)
+            waiter.start()
+        monitor.start_loop()
+        if process is not None:
+            waiter.join()
+        for inst in instances:
+            inst.close()
+        if proc is not None:
+            proc.close()
+        output_file.close()
+        if process is None:
+            sys.exit(127)
+        # same exit status as a shell
+        sys.exit(process.returncode if process.returncode >= 0 else 128 - process.returncode)
+    elif args.command == 'serve':
+        from .aggregator import Aggregator
+        import asyncio
+        try:
+            output_file = open_output_file(args.output_file, args.format, args.compression)
+        except (ValueError, ImportError) as e:
+            parser.error(str(e))
+        aggregator = Aggregator(output_file, output_format=args.format, max_delay=args.max_delay)
+        asyncio.run(aggregator.serve(args.host, args.port, handle_signals=True))
+        output_file.close()
+        print('Received %d rows from %d collectors' % (aggregator.nb_rows, aggregator.nb_collectors))
+        if aggregator.nb_late_rows > 0:
+            sys.stderr.write('WARNING: %d rows were received too late to be written in order\n' %
+                             aggregator.nb_late_rows)
+    elif args.command == 'selfbench':
+        for target in args.targets:
+            if target not in monitor_classes:
+                parser.error('unknown target %s' % target)
+        results = selfbench(args.targets or list(monitor_classes), nb_samples=args.nb_samples,
+                            time_interval=args.time_interval, persistent=args.high_rate,
+                            proc_backend=args.proc_backend)
+        for i, (target, summary) in enumerate(results.items()):
+            if i == 0:
+                print('%-14s' % 'target' + ''.join('%14s' % key for key in summary))
+            print('%-14s' % target + ''.join('%14.1f' % val for val in summary.values()))
     elif args.command == 'plot':
         try:
-            drawer = Drawer(args.input_file)
-            plot = drawer.create_plot(args.column_name)
+            drawer = Drawer(args.input_file, columns=args.column_name or None, start=args.start, end=args.end,
+                            cache=not args.no_cache)
             if args.output:
+                plot = drawer.create_plot(args.column_name, max_points=args.max_points, width=25, dpi=300)
                 plot.save(args.output, dpi=300, height=13.35, width=25)
             else:
+                plot = drawer.create_plot(args.column_name, max_points=args.max_points)
                 str(plot)
         except Exception as e:
             sys.exit(e)
     elif args.command == 'merge':
         try:
-            merge_files(args.input_file, args.output_file)
+            merge_files(args.input_file, args.output_file, output_format=args.format, jobs=args.jobs,
+                        compression=args.compression, start=args.start, end=args.end)
         except Exception as e:
             sys.exit(e)
     else:
@@ -0,0 +1,198 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import json
+import signal
+import socket
+import struct
+import time
+from array import array
+from .storage import BinaryTraceWriter, EPOCH, trace_writers
+
+
+def parse_address(address):
+    '''
+    Return the host and port of an address of the form "tcp://host:port" (the prefix being optional).
+    '''
+    if address.startswith('tcp://'):
+        address = address[len('tcp://'):]
+    host, _, port = address.rpartition(':')
+    if host == '' or not port.isdigit():
+        raise ValueError('Expected an address of the form tcp://host:port, got "%s"' % address)
+    return host.strip('[]'), int(port)
+
+
+def connect_sink(address):
+    '''
+    Connect to the aggregator listening at the given address and return a binary file object, in which a binary
+    trace is written (see BinaryTraceWriter). The connection is closed with the file.
+    '''
+    sock = socket.create_connection(parse_address(address))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    file = sock.makefile('wb')
+    # the socket is now only referenced by the file
+    sock.close()
+    return file
+
+
+class RecordDecoder:
+    '''
+    Convert the records of a binary trace into rows in long format, i.e. lists [hostname, timestamp, variable, value]
+    with the timestamp as a number of seconds since EPOCH.
+    The trace may itself be in long format (columns variable and value) or not (one variable per column).
+    '''
+    def __init__(self, schema):
+        self.columns = schema['columns']
+        self.record_size = 8 * len(self.columns)
+        self.timestamp_index = self.columns.index('timestamp')
+        categories = schema['categories']
+        if 'hostname' in categories:
+            index, names = self.columns.index('hostname'), categories['hostname']
+            self.hostname = lambda record: names[int(record[index])]
+        else:
+            hostname = schema['constants'].get('hostname', '')
+            self.hostname = lambda record: hostname
+        if 'variable' in categories and 'value' in self.columns:
+            self.variables = None
+            self.variable_index = self.columns.index('variable')
+            self.variable_names = categories['variable']
+            self.value_index = self.columns.index('value')
+        else:
+            self.variables = [(i, col) for i, col in enumerate(self.columns)
+                              if col not in ('timestamp', 'hostname')]
+
+    def decode(self, data):
+        records = array('d')
+        records.frombytes(data)
+        nb_columns = len(self.columns)
+        rows = []
+        for start in range(0, len(records), nb_columns):
+            record = records[start:start+nb_columns]
+            hostname = self.hostname(record)
+            timestamp = record[self.timestamp_index]
+            if self.variables is None:
+                rows.append([hostname, timestamp, self.variable_names[int(record[self.variable_index])],
+                             record[self.value_index]])
+            else:
+                rows.extend([hostname, timestamp, col, record[i]] for i, col in self.variables)
+        return rows
+
+
+class Aggregator:
+    '''
+    Server receiving the binary traces sent by collectors over TCP (see connect_sink) and writing them into a single
+    trace, in long format, ordered by timestamp.
+    The rows are kept in a heap until the watermark, i.e. the oldest of the last timestamps received from each
+    collector, goes past them. The collectors that did not send anything for max_delay seconds are not waited for,
+    their rows arriving after the watermark being written as soon as they are received (they are counted in
+    nb_late_rows).
+    '''
+    header = ['hostname', 'timestamp', 'variable', 'value']
+
+    def __init__(self, output_file, output_format='csv', max_delay=10, clock=time.monotonic):
+        self.writer = trace_writers[output_format](output_file, self.header)
+        self.max_delay = max_delay
+        self.clock = clock
+        self.pending = []
+        self.counter = itertools.count()
+        # for each connected collector: [last timestamp received, instant of the last reception]
+        self.sources = {}
+        self.connections = set()
+        self.last_written = float('-inf')
+        self.nb_rows = 0
+        self.nb_late_rows = 0
+        self.nb_collectors = 0
+        self.address = None
+        self.loop = None
+        self.stop_event = None
+
+    def watermark(self):
+        now = self.clock()
+        active = [timestamp for timestamp, instant in self.sources.values() if now - instant < self.max_delay]
+        return min(active) if len(active) > 0 else float('inf')
+
+    def push(self, rows):
+        for row in rows:
+            if row[1] < self.last_written:
+                self.nb_late_rows += 1
+            heapq.heappush(self.pending, (row[1], next(self.counter), row))
+        self.nb_rows += len(rows)
+
+    def write_ready(self):
+        '''
+        Write the pending rows older than the watermark.
+        '''
+        watermark = self.watermark()
+        batch = []
+        while len(self.pending) > 0 and self.pending[0][0] <= watermark:
+            timestamp, _, row = heapq.heappop(self.pending)
+            row[1] = EPOCH + datetime.timedelta(seconds=timestamp)
+            batch.append(row)
+        if len(batch) > 0:
+            self.last_written = max(self.last_written, timestamp)
+            self.writer.writerows(batch)
+
+    async def handle(self, reader, writer):
+        self.connections.add(writer)
+        key = next(self.counter)
+        try:
+            magic = await reader.readexactly(len(BinaryTraceWriter.MAGIC))
+            if magic != BinaryTraceWriter.MAGIC:
+                return
+            schema_size, = struct.unpack('<I', await reader.readexactly(4))
+            decoder = RecordDecoder(json.loads((await reader.readexactly(schema_size)).decode()))
+            self.nb_collectors += 1
+            self.sources[key] = [float('-inf'), self.clock()]
+            buffer = b''
+            while True:
+                data = await reader.read(1 << 16)
+                if len(data) == 0:
+                    break
+                buffer += data
+                size = len(buffer) - len(buffer) % decoder.record_size
+                rows = decoder.decode(buffer[:size])
+                buffer = buffer[size:]
+                if len(rows) > 0:
+                    self.push(rows)
+                    self.sources[key] = [rows[-1][1], self.clock()]
+                self.write_ready()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            self.sources.pop(key, None)
+            self.connections.discard(writer)
+            writer.close()
+            self.write_ready()
+
+    async def serve(self, host, port, handle_signals=False, ready=None):
+        '''
+        Accept connections until stop is called (or SIGINT is received, if handle_signals is True), then write the
+        remaining rows. The address actually used (e.g. when port is 0) is stored in the address attribute, and the
+        optional threading.Event ready is set once the server accepts connections.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        if handle_signals:
+            self.loop.add_signal_handler(signal.SIGINT, self.stop_event.set)
+        server = await asyncio.start_server(self.handle, host, port)
+        self.address = server.sockets[0].getsockname()[:2]
+        if ready is not None:
+            ready.set()
+        await self.stop_event.wait()
+        server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await server.wait_closed()
+        # let the handlers of the closed connections finish
+        while len(self.connections) > 0:
+            await asyncio.sleep(0.01)
+        self.sources.clear()
+        self.write_ready()
+        self.writer.close()
+
+    def stop(self):
+        '''
+        Stop the server, from any thread.
+        '''
+        self.loop.call_soon_threadsafe(self.stop_event.set)
@@ -0,0 +1,111 @@
+'''
+Generation of fake sysfs and procfs trees, to test and benchmark the watchers at scales not available on the local
+machine (e.g. 1024 cores or 16 RAPL domains).
+'''
+import os
+
+
+def write_file(filename, content):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        f.write(content)
+
+
+def make_cpufreq_tree(root, nb_cores, frequency=2000000):
+    '''
+    Fake /sys/devices/system/cpu, with a scaling_cur_freq file (in kHz) for each core.
+    '''
+    for core in range(nb_cores):
+        write_file(os.path.join(root, 'cpu%d' % core, 'cpufreq', 'scaling_cur_freq'), '%d\n' % (frequency + core))
+
+
+def make_rapl_tree(root, nb_packages, domains=('core', 'uncore', 'dram'), energy=0,
+                   max_energy_range=262143328850):
+    '''
+    Fake /sys/devices/virtual/powercap/intel-rapl, with a zone for each package and a subzone for each of the given
+    domains in each package.
+    '''
+    def make_zone(dirname, name):
+        write_file(os.path.join(dirname, 'name'), name + '\n')
+        write_file(os.path.join(dirname, 'energy_uj'), '%d\n' % energy)
+        write_file(os.path.join(dirname, 'max_energy_range_uj'), '%d\n' % max_energy_range)
+    for package in range(nb_packages):
+        dirname = os.path.join(root, 'intel-rapl:%d' % package)
+        make_zone(dirname, 'package-%d' % package)
+        for i, domain in enumerate(domains):
+            make_zone(os.path.join(dirname, 'intel-rapl:%d:%d' % (package, i)), domain)
+
+
+def make_hwmon_tree(root, nb_packages, nb_cores):
+    '''
+    Fake /sys/class/hwmon, with a coretemp device for each package, giving the temperature of the package and of its
+    share of the cores.
+    '''
+    cores_per_package = max(nb_cores // nb_packages, 1)
+    for package in range(nb_packages):
+        dirname = os.path.join(root, 'hwmon%d' % package)
+        write_file(os.path.join(dirname, 'name'), 'coretemp\n')
+        labels = ['Package id %d' % package] + ['Core %d' % core for core in range(cores_per_package)]
+        for i, label in enumerate(labels, start=1):
+            write_file(os.path.join(dirname, 'temp%d_label' % i), label + '\n')
+            write_file(os.path.join(dirname, 'temp%d_input' % i), '%d\n' % (40000 + i*100))
+
+
+def make_proc_tree(root, nb_cores, interfaces=('eth0',)):
+    '''
+    Fake /proc, with the stat, meminfo and net/dev files.
+    '''
+    jiffies = [1000, 10, 500, 8000, 100, 20, 30, 0, 0, 0]
+    lines = ['cpu  %s' % ' '.join(str(v*nb_cores) for v in jiffies)]
+    lines.extend('cpu%d %s' % (core, ' '.join(str(v) for v in jiffies)) for core in range(nb_cores))
+    lines.extend(['intr 100000 5 6', 'ctxt 200000', 'btime 1600000000', 'softirq 50000 1 2'])
+    write_file(os.path.join(root, 'stat'), '\n'.join(lines) + '\n')
+    write_file(os.path.join(root, 'meminfo'), 'MemTotal:       16000000 kB\nMemFree:         8000000 kB\n'
+                                              'MemAvailable:   12000000 kB\n')
+    lines = ['Inter-|   Receive', ' face |bytes    packets']
+    lines.extend('%6s: 1000 10 0 0 0 0 0 0 2000 20 0 0 0 0 0 0' % nic for nic in interfaces)
+    write_file(os.path.join(root, 'net', 'dev'), '\n'.join(lines) + '\n')
+
+
+class FakeSystem:
+    '''
+    Fake machine in the directory root, with the given number of cores and packages, RAPL domains per package and
+    network interfaces. The watchers of its sysfs and procfs trees are built with create_watcher.
+    '''
+    targets = ['cpu_freq', 'cpu_power', 'temperature', 'cpu_load', 'cpu_core_load', 'cpu_stats', 'memory_usage',
+               'network', 'network_packets']
+
+    def __init__(self, root, nb_cores=4, nb_packages=1, rapl_domains=('core', 'uncore', 'dram'),
+                 interfaces=('eth0',)):
+        self.cpu_root = os.path.join(root, 'sys', 'devices', 'system', 'cpu')
+        self.rapl_root = os.path.join(root, 'sys', 'devices', 'virtual', 'powercap', 'intel-rapl')
+        self.hwmon_root = os.path.join(root, 'sys', 'class', 'hwmon')
+        self.proc_root = os.path.join(root, 'proc')
+        make_cpufreq_tree(self.cpu_root, nb_cores)
+        make_rapl_tree(self.rapl_root, nb_packages, rapl_domains)
+        make_hwmon_tree(self.hwmon_root, nb_packages, nb_cores)
+        make_proc_tree(self.proc_root, nb_cores, interfaces)
+        self.proc = None
+
+    def create_watcher(self, target, persistent=False):
+        '''
+        Return the watcher of the given target (one of the targets attribute) reading the fake trees, the procfs ones
+        sharing a ProcFS.
+        '''
+        from .ratatouille import monitor_classes, ProcFS
+        cls = monitor_classes[target]
+        if target == 'cpu_freq':
+            return cls(persistent=persistent, root=self.cpu_root)
+        if target == 'cpu_power':
+            return cls(persistent=persistent, root=self.rapl_root)
+        if target == 'temperature':
+            return cls(persistent=persistent, hwmon_root=self.hwmon_root)
+        if target not in self.targets:
+            raise ValueError('Target %s cannot be faked' % target)
+        if self.proc is None:
+            self.proc = ProcFS(self.proc_root)
+        return cls(proc=self.proc)
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.close()
@@ -1,5 +1,13 @@
-import csv
 import datetime
+import fnmatch
+import functools
+import glob
+import heapq
+import itertools
+import json
+import math
+import queue
+import threading
 import time
 import psutil
 import re
@@ -7,7 +15,9 @@ import socket
 import signal
 import sys
 import os
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
+from .storage import trace_writers, BufferedTraceWriter, RingBufferWriter, TraceReader, STRING_COLUMNS, read_trace
+from .storage import read_trace_header, open_output_file, EPOCH, timestamp_to_seconds, TimeIndexWriter
 
 
 class RatatouilleDependencyError(Exception):
@@ -18,7 +28,305 @@ class RatatouillePortabilityError(Exception):
     pass
 
 
+class LatencyHistogram:
+    '''
+    Histogram of durations (in seconds) with logarithmic buckets, four per power of two starting at min_value, so
+    that recording a duration takes a constant time and the memory usage is constant.
+    The quantiles are approximated by the upper bound of their bucket, i.e. with a relative error below 19%.
+    '''
+    def __init__(self, min_value=1e-6, nb_buckets=128, buckets_per_octave=4):
+        self.min_value = min_value
+        self.buckets_per_octave = buckets_per_octave
+        self.buckets = [0] * nb_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        if value <= self.min_value:
+            index = 0
+        else:
+            index = min(len(self.buckets) - 1, 1 + int(math.log2(value / self.min_value) * self.buckets_per_octave))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def upper_bound(self, index):
+        return self.min_value * 2 ** (index / self.buckets_per_octave)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return float('nan')
+        threshold = q * self.count
+        cumulated = 0
+        for index, nb in enumerate(self.buckets):
+            cumulated += nb
+            if cumulated >= threshold and nb > 0:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count > 0 else float('nan')
+
+
+class ValueHistogram:
+    '''
+    Histogram of arbitrary values with logarithmic buckets, buckets_per_octave per power of two (for the positive and
+    negative values separately), together with their count, sum, min and max.
+    Only the non-empty buckets are stored, so the memory usage is bounded whatever the number of values (a few
+    hundred buckets for values spanning the whole range of the measures). The quantiles are approximated by the
+    middle of their bucket, i.e. with a relative error below 2.2% with 16 buckets per octave.
+    '''
+    def __init__(self, buckets_per_octave=16):
+        self.buckets_per_octave = buckets_per_octave
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def record(self, value):
+        # the buckets are identified by the sign of their values and their index among the buckets of this sign
+        if value > 0:
+            key = (1, math.floor(math.log2(value) * self.buckets_per_octave))
+        elif value < 0:
+            key = (-1, math.floor(math.log2(-value) * self.buckets_per_octave))
+        elif value == 0:
+            key = (0, 0)
+        else:  # NaN
+            return
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def bucket_value(self, key):
+        sign, index = key
+        return sign * 2 ** ((index + 0.5) / self.buckets_per_octave)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return float('nan')
+        threshold = q * self.count
+        cumulated = 0
+        for value, nb in sorted((self.bucket_value(key), nb) for key, nb in self.buckets.items()):
+            cumulated += nb
+            if cumulated >= threshold:
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count > 0 else float('nan')
+
+
+class WindowSummary:
+    '''
+    Streaming statistics of each variable over consecutive time windows of the given duration (in seconds), aligned
+    on the multiples of this duration since EPOCH.
+    The rows given to add and returned by add and flush are in long format, i.e. [hostname, timestamp, variable,
+    value]. The rows returned give, for each variable of a finished window, its min, mean, max and 99th percentile
+    (the variables being suffixed with _min, _mean, _max and _p99), timestamped with the start of the window, as an
+    ISO string with microseconds (str would omit them on the whole seconds, mixing two formats in a trace).
+    '''
+    statistics = ['min', 'mean', 'max', 'p99']
+
+    def __init__(self, window):
+        self.window = window
+        self.current = None
+        self.hostname = None
+        self.histograms = OrderedDict()
+
+    @classmethod
+    def variables(cls, columns):
+        return ['%s_%s' % (col, stat) for col in columns for stat in cls.statistics]
+
+    def add(self, rows):
+        '''
+        Record the given rows, all with the same timestamp, and return the rows of the windows finished before them.
+        '''
+        if len(rows) == 0:
+            return []
+        hostname, timestamp = rows[0][:2]
+        index = math.floor((timestamp - EPOCH).total_seconds() / self.window)
+        summary = []
+        if self.current is not None and index != self.current:
+            summary = self.flush()
+        self.current = index
+        self.hostname = hostname
+        for _, _, variable, value in rows:
+            histogram = self.histograms.get(variable)
+            if histogram is None:
+                histogram = self.histograms[variable] = ValueHistogram()
+            histogram.record(value)
+        return summary
+
+    def flush(self):
+        '''
+        Return the rows of the current window and start a new one.
+        '''
+        if self.current is None:
+            return []
+        start = EPOCH + datetime.timedelta(seconds=self.current * self.window)
+        start = start.isoformat(sep=' ', timespec='microseconds')
+        rows = []
+        for variable, histogram in self.histograms.items():
+            if histogram.count == 0:
+                values = [float('nan')] * len(self.statistics)
+            else:
+                values = [histogram.min, histogram.mean, histogram.max, histogram.quantile(0.99)]
+            rows.extend([self.hostname, start, '%s_%s' % (variable, stat), value]
+                        for stat, value in zip(self.statistics, values))
+        self.current = None
+        self.histograms = OrderedDict()
+        return rows
+
+
+class ThreadIOCounters(threading.local):
+    '''
+    Number of files opened by ratatouille in the current thread, and persistent handle on the I/O statistics of the
+    current thread (to count the read syscalls, including the ones done by psutil).
+    '''
+    files_opened = 0
+    io_file = None
+
+    def read_syscalls(self):
+        if self.io_file is None:
+            try:
+                self.io_file = SysfsFile('/proc/thread-self/io', buffer_size=512)
+            except OSError:
+                return float('nan')
+        content = self.io_file.read()
+        start = content.index(b'syscr:') + len(b'syscr:')
+        # the read of the I/O statistics is itself a read syscall
+        return int(content[start:content.index(b'\n', start)]) - self.io_file.nb_reads
+
+
+thread_io = ThreadIOCounters()
+
+
+class WatcherInstrumentation:
+    '''
+    Statistics on the calls to get_values of a watcher: latencies, CPU time, number of files opened by ratatouille and
+    number of read syscalls.
+    '''
+    def __init__(self):
+        self.latencies = LatencyHistogram()
+        self.cpu_time = 0.0
+        self.files_opened = 0
+        self.read_syscalls = 0
+
+    def measure(self, func):
+        # the I/O statistics file may be opened by this first call, this must not count as a file opened by the watcher
+        read_syscalls = thread_io.read_syscalls()
+        files_opened = thread_io.files_opened
+        start = time.perf_counter()
+        start_cpu = time.thread_time()
+        values = func()
+        self.cpu_time += time.thread_time() - start_cpu
+        self.latencies.record(time.perf_counter() - start)
+        self.read_syscalls += thread_io.read_syscalls() - read_syscalls
+        self.files_opened += thread_io.files_opened - files_opened
+        return values
+
+    def summary(self):
+        calls = max(1, self.latencies.count)
+        return OrderedDict([
+            ('calls', self.latencies.count),
+            ('mean_us', self.latencies.mean * 1e6),
+            ('p50_us', self.latencies.quantile(0.5) * 1e6),
+            ('p99_us', self.latencies.quantile(0.99) * 1e6),
+            ('max_us', self.latencies.max * 1e6),
+            ('cpu_us', self.cpu_time / calls * 1e6),
+            ('files_opened', self.files_opened / calls),
+            ('read_syscalls', self.read_syscalls / calls),
+        ])
+
+
+class DiscoveryCache:
+    '''
+    Results of the discovery of the sysfs files read by the watchers (e.g. the cpufreq, intel-rapl and hwmon files),
+    kept in a JSON file so that the following runs skip the directory walks.
+    The results are only reused during the same boot, the devices and their numbering possibly changing on reboot.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self.boot_id = get_string_in_file('/proc/sys/kernel/random/boot_id')
+        except (OSError, AssertionError):
+            self.boot_id = None
+        self.entries = {}
+        self.modified = False
+        try:
+            with open(self.filename) as f:
+                content = json.load(f)
+            if self.boot_id is not None and content['boot_id'] == self.boot_id:
+                self.entries = content['entries']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    @staticmethod
+    def default_filename():
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache_dir, 'ratatouille', 'discovery.json')
+
+    def get(self, key, discover):
+        key = json.dumps(key)
+        if key not in self.entries:
+            self.entries[key] = discover()
+            self.modified = True
+        return self.entries[key]
+
+    def save(self):
+        if not self.modified or self.boot_id is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                json.dump({'boot_id': self.boot_id, 'entries': self.entries}, f)
+            os.replace(tmp_filename, self.filename)
+            self.modified = False
+        except OSError:
+            pass
+
+
+# Set to a DiscoveryCache to reuse the discovery of the sysfs files between runs
+discovery_cache = None
+
+
+def enable_discovery_cache(filename=None):
+    '''
+    Reuse the discovery of the sysfs files between runs, storing it in the given file (by default in the cache
+    directory of the user). Return the DiscoveryCache, to be saved once the watchers are created.
+    '''
+    global discovery_cache
+    discovery_cache = DiscoveryCache(filename or DiscoveryCache.default_filename())
+    return discovery_cache
+
+
+def cached_discovery(key, discover):
+    '''
+    Return the result of discover(), a JSON-serializable value identified by the given key, from the discovery cache
+    if it is enabled.
+    '''
+    if discovery_cache is None:
+        return discover()
+    return discovery_cache.get(key, discover)
+
+
 class AbstractWatcher:
+    # Set to True by the watchers accepting a "persistent" argument, i.e. able to keep their files open
+    supports_persistent_files = False
+    # Set to True by the watchers accepting a "proc" argument, i.e. able to read their values through a ProcFS
+    supports_proc = False
+    proc = None
+    # Set by enable_instrumentation
+    instrumentation = None
+
     def __init__(self):
         self.first_values = self.get_values()
         self.nb_values = len(self.first_values)
@@ -26,6 +334,20 @@ class AbstractWatcher:
     def get_values(self):
         raise NotImplementedError()
 
+    def enable_instrumentation(self):
+        self.instrumentation = WatcherInstrumentation()
+
+    def sample(self):
+        '''
+        Return the values of get_values, recording statistics on the call if the instrumentation is enabled.
+        '''
+        if self.instrumentation is None:
+            return self.get_values()
+        return self.instrumentation.measure(self.get_values)
+
+    def close(self):
+        pass
+
     def checked_get_values(self):
         values = self.get_values()
         assert self.nb_values == len(values)
@@ -35,12 +357,140 @@ class AbstractWatcher:
         return ['%s%s' % (prefix, suf) for suf in suffixes]
 
 
+class SysfsFile:
+    '''
+    A file kept open, re-read from its beginning with a single pread into a reused buffer.
+    Meant for the small sysfs files that are read at each measure (e.g. cpufreq, intel-rapl), the buffer being
+    enlarged if needed for larger files (e.g. /proc/stat).
+    '''
+    def __init__(self, filename, buffer_size=64):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDONLY)
+        thread_io.files_opened += 1
+        self.buffer = bytearray(buffer_size)
+        self.buffers = [self.buffer]
+        self.nb_reads = 0
+
+    def read(self):
+        nbytes = os.preadv(self.fd, self.buffers, 0)
+        self.nb_reads += 1
+        while nbytes == len(self.buffer):
+            # the file may be larger than the buffer
+            self.buffer = bytearray(2*len(self.buffer))
+            self.buffers = [self.buffer]
+            nbytes = os.preadv(self.fd, self.buffers, 0)
+            self.nb_reads += 1
+        return self.buffer[:nbytes]
+
+    def read_int(self):
+        return int(self.read())
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class ProcFS:
+    '''
+    Reader of the /proc files shared by several watchers (e.g. /proc/stat for CPULoad and CPUStats).
+    Each file is kept open and read at most once per measure into a reused buffer, then parsed in a single pass. The
+    parsed content is cached until the next measure, i.e. until invalidate() is called (by Monitor, before each
+    measure) or until a watcher asks again for a file it already got.
+    '''
+    def __init__(self, root='/proc'):
+        self.root = root
+        self.files = {}
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.cache.clear()
+
+    def get(self, name, parser, consumer):
+        with self.lock:
+            parsed, consumers = self.cache.get(name, (None, None))
+            if consumers is None or consumer in consumers:
+                if name not in self.files:
+                    self.files[name] = SysfsFile(os.path.join(self.root, name), buffer_size=4096)
+                parsed, consumers = parser(bytes(self.files[name].read())), set()
+                self.cache[name] = (parsed, consumers)
+            consumers.add(consumer)
+            return parsed
+
+    @staticmethod
+    def parse_stat(content):
+        '''
+        Return a dictionary with the fields of the global "cpu" line (as a list of jiffies), "ctxt" and the totals of
+        "intr" and "softirq". The raw content is also kept, for the per-core lines.
+        '''
+        stat = {'raw': content}
+        for line in content.split(b'\n'):
+            key, _, values = line.partition(b' ')
+            if key == b'cpu':
+                stat['cpu'] = [int(v) for v in values.split()]
+            elif key in (b'ctxt', b'intr', b'softirq'):
+                stat[key.decode()] = int(values.split(None, 1)[0])
+        return stat
+
+    @staticmethod
+    def parse_meminfo(content):
+        '''
+        Return a dictionary mapping each field to its value (in bytes for the fields given in kB).
+        '''
+        meminfo = {}
+        for line in content.split(b'\n'):
+            key, _, values = line.partition(b':')
+            values = values.split()
+            if len(values) > 0:
+                meminfo[key.decode()] = int(values[0]) * (1024 if len(values) > 1 else 1)
+        return meminfo
+
+    @staticmethod
+    def parse_net_dev(content):
+        '''
+        Return a dictionary mapping each interface to the list of its 16 counters (8 for the reception, then 8 for
+        the transmission, starting with the bytes and the packets).
+        '''
+        net_dev = {}
+        for line in content.split(b'\n')[2:]:
+            nic, _, values = line.partition(b':')
+            if len(values) > 0:
+                net_dev[nic.strip().decode()] = [int(v) for v in values.split()]
+        return net_dev
+
+    def stat(self, consumer):
+        return self.get('stat', self.parse_stat, consumer)
+
+    def meminfo(self, consumer):
+        return self.get('meminfo', self.parse_meminfo, consumer)
+
+    def net_dev(self, consumer):
+        return self.get('net/dev', self.parse_net_dev, consumer)
+
+    def close(self):
+        for handle in self.files.values():
+            handle.close()
+        self.files = {}
+
+
 class FileWatcher(AbstractWatcher):
-    def __init__(self, prefix, name, suffix):
+    supports_persistent_files = True
+
+    def __init__(self, prefix, name, suffix, persistent=False):
         '''
         Suppose files of the form prefix/name42/suffix
+        If persistent is True, the files are kept open between two measures.
         '''
-        self.files = {}
+        self.filenames = cached_discovery(['files', prefix, name, suffix],
+                                          lambda: self.find_files(prefix, name, suffix))
+        self.handles = [SysfsFile(filename) for filename in self.filenames] if persistent else None
+        super().__init__()
+
+    @staticmethod
+    def find_files(prefix, name, suffix):
+        files = {}
         regex = re.compile('^%s(?P<id>\\d+)$' % name)
         for dirname in os.listdir(prefix):
             match = regex.match(dirname)
@@ -49,37 +499,160 @@ class FileWatcher(AbstractWatcher):
                 filename = os.path.join(prefix, dirname, suffix)
                 if not os.path.isfile(filename):
                     raise RatatouillePortabilityError(f'File {filename} not found')
-                self.files[new_id] = filename
+                files[new_id] = filename
+        return [filename for _, filename in sorted(files.items())]
+
+    def get_values(self):
+        if self.handles is not None:
+            return [handle.read_int() for handle in self.handles]
+        return [int(get_string_in_file(filename)) for filename in self.filenames]
+
+    def close(self):
+        if self.handles is not None:
+            for handle in self.handles:
+                handle.close()
+
+
+class ChildTimes(AbstractWatcher):
+    '''
+    Start and exit instants of a child process (e.g. the command launched by "ratatouille run"), as set with
+    mark_start and mark_exit. They are given as numbers of seconds since EPOCH in local time, like the timestamps of
+    the binary traces, NaN until the corresponding event has happened.
+    '''
+    header = ['child_start', 'child_exit']
+
+    def __init__(self):
+        self.start = float('nan')
+        self.exit = float('nan')
+        super().__init__()
+
+    def mark_start(self):
+        self.start = timestamp_to_seconds(datetime.datetime.now())
+
+    def mark_exit(self):
+        self.exit = timestamp_to_seconds(datetime.datetime.now())
+
+    def get_values(self):
+        return [self.start, self.exit]
+
+
+class ProcWatcher(AbstractWatcher):
+    '''
+    Watcher that can read its values from a ProcFS shared with other watchers, instead of psutil.
+    If the needed /proc file cannot be read or parsed, psutil is used instead.
+    '''
+    supports_proc = True
+
+    def __init__(self, proc=None):
+        self.proc = proc
+        if self.proc is not None:
+            try:
+                self.get_proc_values()
+            except (OSError, KeyError, ValueError, IndexError):
+                self.proc = None
         super().__init__()
 
     def get_values(self):
-        values = []
-        for i, filename in self.files.items():
-            values.append((i, int(get_string_in_file(filename))))
-        values.sort()
-        return [val[1] for val in values]
+        if self.proc is not None:
+            return self.get_proc_values()
+        return self.get_psutil_values()
 
 
-class CPULoad(AbstractWatcher):
+class CPULoad(ProcWatcher):
     header = ['cpu_load']
 
-    def get_values(self):
+    def get_psutil_values(self):
         return [psutil.cpu_percent()]
 
+    def get_proc_values(self):
+        # same computation as psutil.cpu_percent: the guest times are already counted in the user times, and the
+        # iowait time is idle
+        jiffies = self.proc.stat(self)['cpu']
+        total = sum(jiffies[:8])
+        idle = jiffies[3] + jiffies[4]
+        last_total, last_idle = getattr(self, 'last_jiffies', (None, None))
+        self.last_jiffies = (total, idle)
+        if last_total is None or total <= last_total:
+            return [float('nan')]
+        busy = (total - last_total) - (idle - last_idle)
+        return [round(busy / (total - last_total) * 100, 1)]
+
+
+class CPUCoreLoad(AbstractWatcher):
+    '''
+    Percentage of the time spent by each core in user mode (including nice), system mode, waiting for I/O and serving
+    interrupts (including soft interrupts) since the previous measure, computed from /proc/stat.
+    The jiffies of all the cores are handled as a single array, so the cost of a measure does not grow much with the
+    number of cores. If the set of online cores changes, the values are NaN.
+    '''
+    supports_proc = True
+    kinds = ['user', 'system', 'iowait', 'irq']
+
+    def __init__(self, proc=None):
+        try:
+            import numpy
+        except ImportError:
+            raise RatatouilleDependencyError('Package \'numpy\' is required for the cpu_core_load target.')
+        self.numpy = numpy
+        self.own_proc = proc is None
+        self.proc = ProcFS() if proc is None else proc
+        # rows of the user, nice, system, idle, iowait, irq, softirq and steal columns to sum for each kind
+        self.weights = numpy.array([
+            [1, 1, 0, 0, 0, 0, 0, 0],
+            [0, 0, 1, 0, 0, 0, 0, 0],
+            [0, 0, 0, 0, 1, 0, 0, 0],
+            [0, 0, 0, 0, 0, 1, 1, 0],
+        ])
+        try:
+            self.nb_cores = len(self.read_jiffies())
+        except (OSError, ValueError):
+            raise RatatouillePortabilityError('Cannot read the per-core times in /proc/stat.')
+        self.header = ['%s_load_core_%d' % (kind, core) for kind in self.kinds for core in range(self.nb_cores)]
+        self.last_jiffies = None
+        super().__init__()
+
+    def read_jiffies(self):
+        '''
+        Return an array with a row per core and the eight first columns of the cpuN lines of /proc/stat.
+        '''
+        raw = self.proc.stat(self)['raw']
+        start = raw.index(b'\ncpu0 ') + 1
+        end = raw.index(b'\n', raw.rindex(b'\ncpu') + 1)
+        fields = self.numpy.array(raw[start:end].split())
+        nb_cores = raw.count(b'\ncpu', start - 1)
+        return fields.reshape(nb_cores, -1)[:, 1:9].astype(self.numpy.int64)
+
+    def get_values(self):
+        jiffies = self.read_jiffies()
+        last_jiffies, self.last_jiffies = self.last_jiffies, jiffies
+        if last_jiffies is None or len(jiffies) != self.nb_cores or last_jiffies.shape != jiffies.shape:
+            return [float('nan')] * len(self.header)
+        delta = jiffies - last_jiffies
+        with self.numpy.errstate(divide='ignore', invalid='ignore'):
+            loads = (self.weights @ delta.T) / delta.sum(axis=1) * 100
+        return loads.round(1).ravel().tolist()
+
+    def close(self):
+        if self.own_proc:
+            self.proc.close()
 
-class CPUStats(AbstractWatcher):
+
+class CPUStats(ProcWatcher):
     header = ['ctx_switches', 'interrupts', 'soft_interrupts']
 
-    @staticmethod
-    def get_values():
+    def get_psutil_values(self):
         val = psutil.cpu_stats()
         return [val.ctx_switches, val.interrupts, val.soft_interrupts]
 
+    def get_proc_values(self):
+        stat = self.proc.stat(self)
+        return [stat['ctxt'], stat['intr'], stat['softirq']]
+
 
 class CPUFreq(FileWatcher):
-    def __init__(self):
+    def __init__(self, persistent=False, root='/sys/devices/system/cpu'):
         try:
-            super().__init__('/sys/devices/system/cpu', 'cpu', 'cpufreq/scaling_cur_freq')
+            super().__init__(root, 'cpu', 'cpufreq/scaling_cur_freq', persistent=persistent)
         except RatatouillePortabilityError:
             raise RatatouillePortabilityError('CPU frequency unavailable, could not read cpufreq files')
         self.header = self.build_header('frequency_core_', range(self.nb_values))
@@ -89,12 +662,79 @@ class CPUFreq(FileWatcher):
         return [freq*1000 for freq in frequencies]
 
 
+# Value at which the kernel counters of type unsigned long (e.g. network and disk statistics) wrap around
+KERNEL_COUNTER_RANGE = 2**64 if sys.maxsize > 2**32 else 2**32
+
+
+class CounterRate:
+    '''
+    Rates of change of a batch of cumulative counters, between two consecutive calls to update, using a monotonic
+    clock.
+    The optional ranges give, for each counter, the modulus at which it wraps around to zero (or None). A counter lower
+    than its previous value is considered to have wrapped around once if its range is known and the corrected increase
+    is plausible, otherwise (e.g. the counter has been reset) its rate is NaN. The optional max_rates give, for each
+    counter, the highest possible rate (before scaling) bounding the corrected increase over the elapsed time: infinity
+    accepts one wraparound per interval, and None (the default) accepts the corrected increases less than half of the
+    range.
+    '''
+    def __init__(self, ranges=None, scale=1, clock=time.monotonic, max_rates=None):
+        self.ranges = ranges
+        self.scale = scale
+        self.clock = clock
+        self.max_rates = max_rates
+        self.last_values = None
+        self.last_instant = None
+
+    @staticmethod
+    def increase(new, old, limit, max_increase=None):
+        delta = new - old
+        if delta >= 0:
+            return delta
+        if limit is None:
+            return float('nan')
+        delta += limit
+        if delta <= (max_increase if max_increase is not None else limit / 2):
+            return delta
+        return float('nan')
+
+    def update(self, values):
+        '''
+        Return the rates of the given counter values since the previous call (NaN for the first call), multiplied by
+        the scale.
+        '''
+        instant = self.clock()
+        last_values, last_instant = self.last_values, self.last_instant
+        self.last_values, self.last_instant = values, instant
+        if last_values is None or instant <= last_instant:
+            return [float('nan')] * len(values)
+        elapsed = instant - last_instant
+        factor = self.scale / elapsed
+        ranges = self.ranges if self.ranges is not None else [None] * len(values)
+        max_rates = self.max_rates if self.max_rates is not None else [None] * len(values)
+        return [self.increase(new, old, limit, max_rate * elapsed if max_rate is not None else None) * factor
+                for new, old, limit, max_rate in zip(values, last_values, ranges, max_rates)]
+
+
 class CPUPower(AbstractWatcher):
-    def __init__(self):
+    supports_persistent_files = True
+
+    def __init__(self, persistent=False, root='/sys/devices/virtual/powercap/intel-rapl'):
         try:
-            self.files = self.get_init_files('/sys/devices/virtual/powercap/intel-rapl/', 'intel-rapl', 'energy_uj')
+            self.files = OrderedDict(cached_discovery(['rapl', root], lambda: list(self.get_init_files(
+                root, 'intel-rapl', 'energy_uj').items())))
         except FileNotFoundError:
             raise RatatouillePortabilityError('Power monitoring unavailable, could not read intel-rapl files')
+        self.handles = [SysfsFile(filename) for filename in self.files.values()] if persistent else None
+        # the energy counters wrap around to zero after max_energy_range_uj, which takes minutes at full power: a
+        # long interval may hold a wraparound, but not two
+        ranges = []
+        for filename in self.files.values():
+            try:
+                ranges.append(int(get_string_in_file(os.path.join(os.path.dirname(filename),
+                                                                  'max_energy_range_uj'))) + 1)
+            except (OSError, ValueError, AssertionError):
+                ranges.append(None)
+        self.rates = CounterRate(ranges=ranges, scale=1e-6, max_rates=[float('inf')] * len(ranges))
 
         self.header = ["power_%s" % label for label in self.files.keys()]
         super().__init__()
@@ -112,7 +752,7 @@ class CPUPower(AbstractWatcher):
 
                 # Get core, uncore and dram files
                 regex2 = re.compile('^%s:(?P<id>\\d+)$' % (dirname))
-                for dirname2 in os.listdir("%s%s" % (prefix, dirname)):
+                for dirname2 in os.listdir(os.path.join(prefix, dirname)):
                     match2 = regex2.match(dirname2)
                     if match2: # dirname2 is of the form intel-rapl:<package-id>:<id>
                         label2 = "%s_%s%s" % (label, get_string_in_file(os.path.join(prefix, dirname, dirname2, "name")), label_suffix)
@@ -121,46 +761,138 @@ class CPUPower(AbstractWatcher):
 
 
     def get_values(self):
-        energies = []
-        for filename in self.files.values():
-            energies.append(int(get_string_in_file(filename)))
+        if self.handles is not None:
+            energies = [handle.read_int() for handle in self.handles]
+        else:
+            energies = [int(get_string_in_file(filename)) for filename in self.files.values()]
+        return self.rates.update(energies)
 
-        instant = time.time()
-        try:
-            duration = instant - self.last_instant
-            powers = [(new-old)*1e-6/duration for new, old in zip(energies, self.last_energies)]
-            for i, p in enumerate(powers):
-                if p < 0:
-                    powers[i] = float('nan')
-        except AttributeError:
-            powers = [float('nan') for _ in energies]
-        self.last_instant = instant
-        self.last_energies = energies
-        return powers
+    def close(self):
+        if self.handles is not None:
+            for handle in self.handles:
+                handle.close()
 
 
 def get_string_in_file(filename):
+    thread_io.files_opened += 1
     with open(filename) as f:
         lines = f.readlines()
         assert len(lines) == 1
         return lines[0].rstrip('\n')
 
 
-class MemoryUsage(AbstractWatcher):
+class MemoryUsage(ProcWatcher):
     header = ['memory_available_percent', 'memory_available']
 
-    @staticmethod
-    def get_values():
+    def get_psutil_values(self):
         mem = psutil.virtual_memory()
         return [100-mem.percent, mem.available]
 
+    def get_proc_values(self):
+        meminfo = self.proc.meminfo(self)
+        total, available = meminfo['MemTotal'], meminfo['MemAvailable']
+        # same rounding as psutil.virtual_memory
+        return [100 - round((total - available) / total * 100, 1), available]
+
+
+# A sensor found in /sys/class/hwmon, the current field being the path of its input file
+HwmonSensor = namedtuple('HwmonSensor', ['label', 'current'])
+
+
+def discover_hwmon(root, kind, device_fallback=False):
+    '''
+    Find the hwmon sensors of the given kind (e.g. temp or fan) the same way psutil does, and return them as a
+    dictionary mapping each unit name to its list of HwmonSensor, with the same order as psutil.
+    The sensors in the intermediate device directories are only looked for if there are none at the top level when
+    device_fallback is True, and always otherwise.
+    '''
+    found = cached_discovery(['hwmon', root, kind, device_fallback],
+                             lambda: find_hwmon_sensors(root, kind, device_fallback))
+    sensors = OrderedDict()
+    for unit_name, label, input_file in found:
+        sensors.setdefault(unit_name, []).append(HwmonSensor(label, input_file))
+    return sensors
+
+
+def find_hwmon_sensors(root, kind, device_fallback):
+    '''
+    Return the list of the (unit name, label, input file) of the sensors found by discover_hwmon.
+    '''
+    pattern = '%s*_*' % kind
+    paths = glob.glob(os.path.join(root, 'hwmon*', pattern))
+    device_paths = glob.glob(os.path.join(root, 'hwmon*', 'device', pattern))
+    if not device_fallback or len(paths) == 0:
+        paths.extend(device_paths)
+    basenames = sorted({os.path.join(os.path.dirname(path), os.path.basename(path).split('_')[0]) for path in paths})
+    sensors = []
+    for base in basenames:
+        input_file = base + '_input'
+        try:
+            int(get_string_in_file(input_file))
+            unit_name = get_string_in_file(os.path.join(os.path.dirname(base), 'name')).strip()
+        except (OSError, ValueError, AssertionError):
+            continue
+        label_file = base + '_label'
+        label = get_string_in_file(label_file).strip() if os.path.isfile(label_file) else ''
+        sensors.append((unit_name, label, input_file))
+    return sensors
+
+
+class HwmonWatcher(AbstractWatcher):
+    '''
+    Watcher of hwmon sensors, using a plan built once at construction: the header columns are mapped to the input
+    files of the sensors, so each measure only reads these files.
+    If no sensor is found in the hwmon directory, the values are taken from psutil instead, at each measure.
+    Subclasses define kind (the prefix of the sensor files), scale (the unit of the input files), psutil_sensors
+    (the psutil function to use as fallback) and _build_columns (mapping the sensors to the columns).
+    '''
+    supports_persistent_files = True
+    device_fallback = False
+
+    def __init__(self, persistent=False, hwmon_root='/sys/class/hwmon'):
+        plan = self._build_columns(discover_hwmon(hwmon_root, self.kind, device_fallback=self.device_fallback))
+        if len(plan) > 0:
+            self.header = list(plan)
+            self.files = list(plan.values())
+            self.handles = [SysfsFile(filename) for filename in self.files] if persistent else None
+        else:
+            # psutil may still find sensors elsewhere (e.g. in /sys/class/thermal)
+            self.header = list(self._build_columns(self.psutil_sensors()))
+            self.files = None
+            self.handles = None
+        super().__init__()
+
+    def read_file(self, i):
+        try:
+            if self.handles is not None:
+                value = self.handles[i].read_int()
+            else:
+                value = int(get_string_in_file(self.files[i]))
+        except (OSError, ValueError):
+            # some sensors are transiently unavailable
+            return float('nan')
+        return value if self.scale == 1 else value / self.scale
+
+    def get_values(self):
+        if self.files is None:
+            values = self._build_columns(self.psutil_sensors())
+            return [values.get(k, float('nan')) for k in self.header]
+        return [self.read_file(i) for i in range(len(self.files))]
+
+    def close(self):
+        if self.handles is not None:
+            for handle in self.handles:
+                handle.close()
 
-class Temperature(AbstractWatcher):
+
+class Temperature(HwmonWatcher):
     reg = re.compile('(?:Core (?P<core_id>[0-9]+))|(?:(?:Package|Physical) id (?P<package_id>[0-9]+))')
+    kind = 'temp'
+    scale = 1000.0
 
-    def __init__(self):
-        self.header = list(self._get_values_dict().keys())
-        super().__init__()
+    @staticmethod
+    def psutil_sensors():
+        return psutil.sensors_temperatures()
 
     @classmethod
     def _get_core_temps(cls, temperatures):
@@ -199,8 +931,7 @@ class Temperature(AbstractWatcher):
         return result
 
     @classmethod
-    def _get_values_dict(cls):
-        temperatures = psutil.sensors_temperatures()
+    def _build_columns(cls, temperatures):
         alltemps = cls._get_core_temps(temperatures)
         for key, value in sorted(temperatures.items()):
             if key == 'coretemp':
@@ -214,19 +945,18 @@ class Temperature(AbstractWatcher):
 
         return alltemps
 
-    def get_values(self):
-        values = self._get_values_dict()
-        return [values[k] for k in self.header]
 
+class FanSpeed(HwmonWatcher):
+    kind = 'fan'
+    scale = 1
+    device_fallback = True
 
-class FanSpeed(AbstractWatcher):
-    def __init__(self):
-        self.header = list(self._get_values_dict().keys())
-        super().__init__()
+    @staticmethod
+    def psutil_sensors():
+        return psutil.sensors_fans()
 
     @classmethod
-    def _get_values_dict(cls):
-        speeds = psutil.sensors_fans()
+    def _build_columns(cls, speeds):
         values = {}
         for key, value in sorted(speeds.items()):
             for elt in value:
@@ -240,72 +970,712 @@ class FanSpeed(AbstractWatcher):
         return values
 
 
+class Network(ProcWatcher):
+    # name of the columns, psutil field and position in /proc/net/dev of the counters of each interface
+    counters = [('bytes_sent', 'bytes_sent', 8), ('bytes_recv', 'bytes_recv', 0)]
+
+    def __init__(self, proc=None):
+        try:
+            self.interfaces = sorted(proc.net_dev(self)) if proc is not None else None
+        except (OSError, KeyError, ValueError, IndexError):
+            self.interfaces = None
+        if self.interfaces is None:
+            self.interfaces = list(sorted(psutil.net_io_counters(pernic=True).keys()))
+        self.rates = CounterRate(ranges=[KERNEL_COUNTER_RANGE] * (len(self.interfaces) * len(self.counters)))
+        super().__init__(proc=proc)
+        self.header = ['%s_%s' % (name, nic) for nic in self.interfaces for name, _, _ in self.counters]
+
+    def get_counter_values(self):
+        nan = [float('nan')] * len(self.counters)
+        if self.proc is not None:
+            data = self.proc.net_dev(self)
+            return [val for nic in self.interfaces
+                    for val in ([data[nic][i] for _, _, i in self.counters] if nic in data else nan)]
+        data = psutil.net_io_counters(pernic=True)
+        return [val for nic in self.interfaces
+                for val in ([getattr(data[nic], field) for _, field, _ in self.counters] if nic in data else nan)]
+
+    def get_proc_values(self):
+        return self.get_values()
+
     def get_values(self):
-        values = self._get_values_dict()
-        return [values[k] for k in self.header]
+        return self.rates.update(self.get_counter_values())
+
+
+class NetworkPackets(Network):
+    counters = [
+        ('packets_sent', 'packets_sent', 9),
+        ('packets_recv', 'packets_recv', 1),
+        ('errors_out', 'errout', 10),
+        ('errors_in', 'errin', 2),
+        ('drops_out', 'dropout', 11),
+        ('drops_in', 'dropin', 3),
+    ]
 
 
-class Network(AbstractWatcher):
+class DiskIO(AbstractWatcher):
+    counters = [('read_bytes', 'read_bytes'), ('write_bytes', 'write_bytes'), ('reads', 'read_count'),
+                ('writes', 'write_count')]
+
     def __init__(self):
-        self.interfaces = list(sorted(psutil.net_io_counters(pernic=True).keys()))
+        disks = psutil.disk_io_counters(perdisk=True)
+        if not disks:
+            raise RatatouillePortabilityError('Disk I/O monitoring unavailable, no disk found')
+        self.disks = list(sorted(disks))
+        self.rates = CounterRate(ranges=[KERNEL_COUNTER_RANGE] * (len(self.disks) * len(self.counters)))
         super().__init__()
-        self.header = []
-        for nic in self.interfaces:
-            self.header.extend(['bytes_sent_%s' % nic, 'bytes_recv_%s' % nic])
+        self.header = ['%s_%s' % (name, disk) for disk in self.disks for name, _ in self.counters]
 
     def get_values(self):
-        data = psutil.net_io_counters(pernic=True)
-        byte_numbers = []
-        instant = time.time()
-        for nic in self.interfaces:
-            byte_numbers.extend([data[nic].bytes_sent, data[nic].bytes_recv])
+        data = psutil.disk_io_counters(perdisk=True)
+        nan = [float('nan')] * len(self.counters)
+        return self.rates.update([val for disk in self.disks
+                                  for val in ([getattr(data[disk], field) for _, field in self.counters]
+                                              if disk in data else nan)])
+
+
+class CgroupWatcher(AbstractWatcher):
+    '''
+    Resource usage of the processes of a cgroup (v2), given by its path relative to root or by its directory:
+    CPU load (in percent of a core, in total, in user mode and in system mode), time throttled by the CPU controller
+    (in percent), current memory usage (in bytes) and I/O throughput (bytes and operations per second, summed over
+    the devices), read from cpu.stat, memory.current and io.stat. By default, the cgroup of the current process.
+    The values of the controllers not enabled for the cgroup are NaN.
+    '''
+    supports_persistent_files = True
+    header = ['cgroup_cpu_load', 'cgroup_user_load', 'cgroup_system_load', 'cgroup_throttled', 'cgroup_memory',
+              'cgroup_read_bytes', 'cgroup_write_bytes', 'cgroup_reads', 'cgroup_writes']
+    cpu_fields = [b'usage_usec', b'user_usec', b'system_usec', b'throttled_usec']
+    io_fields = [b'rbytes', b'wbytes', b'rios', b'wios']
+
+    def __init__(self, path=None, persistent=False, root='/sys/fs/cgroup'):
+        if path is None:
+            path = self.read_own_cgroup()
+        if os.path.isfile(os.path.join(path, 'cpu.stat')):
+            self.dirname = path
+        else:
+            self.dirname = os.path.join(root, path.lstrip('/'))
+        if not os.path.isfile(os.path.join(self.dirname, 'cpu.stat')):
+            raise RatatouillePortabilityError('Cgroup monitoring unavailable, no cgroup v2 at %s' % self.dirname)
+        self.filenames = [os.path.join(self.dirname, name) for name in ['cpu.stat', 'memory.current', 'io.stat']]
+        self.filenames = [filename if os.path.isfile(filename) else None for filename in self.filenames]
+        self.handles = None
+        if persistent:
+            self.handles = [None if filename is None else SysfsFile(filename, buffer_size=1024)
+                            for filename in self.filenames]
+        self.rates = CounterRate(ranges=[None] * (len(self.cpu_fields) + len(self.io_fields)))
+        super().__init__()
+
+    @staticmethod
+    def read_own_cgroup():
+        try:
+            with open('/proc/self/cgroup') as f:
+                for line in f:
+                    # e.g. "0::/user.slice/user-1000.slice/session-2.scope", the cgroup v2 entry
+                    if line.startswith('0::'):
+                        return line[3:].strip()
+        except OSError:
+            pass
+        raise RatatouillePortabilityError('Cgroup monitoring unavailable, the current process has no cgroup v2')
+
+    def read(self, i):
+        if self.filenames[i] is None:
+            return None
+        if self.handles is not None:
+            return bytes(self.handles[i].read())
+        with open(self.filenames[i], 'rb') as f:
+            return f.read()
+
+    def get_values(self):
+        nan = float('nan')
+        cpu_stat = {}
+        for line in self.read(0).split(b'\n'):
+            key, _, value = line.partition(b' ')
+            cpu_stat[key] = value
+        counters = [int(cpu_stat[field]) if field in cpu_stat else nan for field in self.cpu_fields]
+        memory = self.read(1)
+        io_stat = self.read(2)
+        if io_stat is None:
+            counters.extend([nan] * len(self.io_fields))
+        else:
+            totals = dict.fromkeys(self.io_fields, 0)
+            for line in io_stat.split(b'\n'):
+                # e.g. "8:0 rbytes=1459200 wbytes=314773504 rios=192 wios=353 dbytes=0 dios=0"
+                for item in line.split()[1:]:
+                    key, _, value = item.partition(b'=')
+                    if key in totals:
+                        totals[key] += int(value)
+            counters.extend(totals[field] for field in self.io_fields)
+        rates = self.rates.update(counters)
+        # the CPU times are in microseconds
+        cpu_loads = [rate * 1e-4 for rate in rates[:len(self.cpu_fields)]]
+        return cpu_loads + [nan if memory is None else int(memory)] + rates[len(self.cpu_fields):]
+
+    def close(self):
+        if self.handles is not None:
+            for handle in self.handles:
+                if handle is not None:
+                    handle.close()
+
+
+class ProcessTree(AbstractWatcher):
+    '''
+    Resource usage of a process (by default, the current one) and of all its descendants: CPU load (in percent of a
+    core), resident memory (in bytes), number of processes and of threads, and I/O throughput (bytes read and written
+    per second, as accounted by the kernel).
+    The psutil.Process handles are kept between two measures, each process being read with oneshot. The new processes
+    are found incrementally: only the PIDs allocated since the previous measure (the last one being given by
+    /proc/loadavg) and listed in /proc (i.e. not the threads) are examined, the whole tree being scanned again only if
+    more than max_scan PIDs were allocated (or if /proc/loadavg cannot be read). The CPU time and I/O of the processes
+    that exited remain in the totals, so the rates do not drop when a process exits.
+    '''
+    header = ['tree_cpu_load', 'tree_memory', 'tree_processes', 'tree_threads', 'tree_read_bytes', 'tree_write_bytes']
+    max_scan = 4096
+
+    def __init__(self, pid=None, proc_root='/proc'):
+        self.proc_root = proc_root
+        self.set_root(os.getpid() if pid is None else pid)
+        super().__init__()
+
+    def set_root(self, pid):
+        '''
+        Watch the tree of the given process from now on (e.g. the command launched by "ratatouille run"), the rates of
+        the next measure being NaN.
+        '''
+        try:
+            self.root = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            raise RatatouillePortabilityError('Process monitoring unavailable, no process %d' % pid)
+        # for each process of the tree: [handle, last cumulative CPU time, bytes read and bytes written]
+        self.processes = {}
+        self.exited = [0, 0, 0]
+        self.last_pid = None
+        self.discover()
+        self.rates = CounterRate()
+
+    def read_last_pid(self):
         try:
-            duration = instant - self.last_instant
-            speeds = [(new-old)/duration for new, old in zip(byte_numbers, self.last_byte_numbers)]
-            for i, p in enumerate(speeds):
-                if p < 0:
-                    speeds[i] = float('nan')
-        except AttributeError:
-            speeds = [float('nan') for _ in byte_numbers]
-        self.last_instant = instant
-        self.last_byte_numbers = byte_numbers
-        return speeds
+            with open(os.path.join(self.proc_root, 'loadavg')) as f:
+                # e.g. "0.28 0.14 0.10 1/72 20379", the last field being the last PID allocated
+                return int(f.read().split()[4])
+        except (OSError, ValueError, IndexError):
+            return None
 
+    def add(self, process):
+        if process.pid not in self.processes:
+            self.processes[process.pid] = [process, 0, 0, 0]
 
-class Monitor:
-    def __init__(self, watchers, output_file, time_interval):
+    def examine(self, pid):
+        '''
+        Add the given process to the tree if its parent is in the tree.
+        '''
+        try:
+            with open(os.path.join(self.proc_root, str(pid), 'status'), 'rb') as f:
+                for line in f:
+                    if line.startswith(b'PPid:'):
+                        if int(line.split()[1]) in self.processes:
+                            self.add(psutil.Process(pid))
+                        break
+        except (OSError, ValueError, IndexError, psutil.NoSuchProcess):
+            pass
+
+    def discover(self):
+        last_pid = self.read_last_pid()
+        if last_pid is None or self.last_pid is None or not 0 <= last_pid - self.last_pid <= self.max_scan:
+            try:
+                for process in [self.root] + self.root.children(recursive=True):
+                    self.add(process)
+            except psutil.NoSuchProcess:
+                pass
+        elif last_pid > self.last_pid:
+            # /proc only lists the thread group leaders, the new threads are skipped without reading their status
+            try:
+                processes = {int(name) for name in os.listdir(self.proc_root) if name.isdigit()}
+            except OSError:
+                processes = set()
+            # the parents usually have lower PIDs than their children
+            for pid in range(self.last_pid + 1, last_pid + 1):
+                if pid in processes:
+                    self.examine(pid)
+        self.last_pid = last_pid
+
+    def get_values(self):
+        self.discover()
+        memory = threads = 0
+        totals = list(self.exited)
+        for pid, entry in list(self.processes.items()):
+            process = entry[0]
+            try:
+                with process.oneshot():
+                    times = process.cpu_times()
+                    entry[1] = times.user + times.system
+                    memory += process.memory_info().rss
+                    threads += process.num_threads()
+                    try:
+                        io = process.io_counters()
+                        entry[2], entry[3] = io.read_bytes, io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        entry[2] = entry[3] = float('nan')
+            except psutil.NoSuchProcess:
+                # the last values read are kept in the totals (the unknown ones being ignored)
+                self.exited = [total + (value if value == value else 0)
+                               for total, value in zip(self.exited, entry[1:])]
+                del self.processes[pid]
+            except psutil.AccessDenied:
+                pass
+            for i in range(3):
+                totals[i] += entry[1 + i]
+        rates = self.rates.update(totals)
+        return [rates[0] * 100, memory, len(self.processes), threads, rates[1], rates[2]]
+
+
+class Scheduler:
+    '''
+    Periodic scheduler using absolute deadlines on a monotonic clock, so the time spent between two calls to wait()
+    does not shift the following deadlines.
+    When a deadline is missed by more than a period, the missed ticks are either skipped (the next deadline stays on
+    the original grid) or caught up (the next ticks are run without sleeping).
+    '''
+    def __init__(self, period, catch_up=False, clock=time.monotonic, sleep=time.sleep, origin=None):
+        self.period = period
+        self.catch_up = catch_up
+        self.clock = clock
+        self.sleep = sleep
+        self.origin = self.clock() if origin is None else origin
+        self.index = 1
+        self.nb_ticks = 0
+        self.nb_skipped = 0
+
+    @property
+    def next_deadline(self):
+        return self.origin + self.index*self.period
+
+    def wait(self):
+        '''
+        Sleep until the next deadline and return the lateness of the wake up, in seconds.
+        '''
+        deadline = self.next_deadline
+        now = self.clock()
+        if now < deadline:
+            self.sleep(deadline - now)
+            now = self.clock()
+        lateness = now - deadline
+        self.index += 1
+        if not self.catch_up and now >= self.next_deadline:
+            missed = int((now - self.next_deadline) // self.period) + 1
+            self.index += missed
+            self.nb_skipped += missed
+        self.nb_ticks += 1
+        return lateness
+
+
+class MultiRateScheduler:
+    '''
+    Several periodic schedulers sharing the same origin.
+    The method wait() sleeps until the earliest deadline, then returns the lateness of the wake up together with the
+    (sorted) indices of all the periods that are due.
+    '''
+    def __init__(self, periods, catch_up=False, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        origin = self.clock()
+        self.schedulers = [Scheduler(period, catch_up=catch_up, clock=clock, sleep=sleep, origin=origin)
+                           for period in periods]
+        # deadlines of different periods that should coincide may differ by a rounding error
+        self.tolerance = min(periods) * 1e-3
+
+    @property
+    def nb_skipped(self):
+        return sum(sched.nb_skipped for sched in self.schedulers)
+
+    def wait(self):
+        first = min(range(len(self.schedulers)), key=lambda i: self.schedulers[i].next_deadline)
+        lateness = self.schedulers[first].wait()
+        now = self.clock()
+        due = []
+        for i, sched in enumerate(self.schedulers):
+            if i == first:
+                due.append(i)
+            elif sched.next_deadline <= now + self.tolerance:
+                sched.wait()
+                due.append(i)
+        return lateness, due
+
+
+class AdaptiveScheduler:
+    '''
+    Scheduler whose period may be changed between two calls to wait(), each deadline being the previous one plus the
+    current period. When a deadline is missed by more than a period, the missed ticks are skipped.
+    The method wait() returns the lateness of the wake up and the indices of the due periods (always [0]), like
+    MultiRateScheduler.
+    '''
+    def __init__(self, period, clock=time.monotonic, sleep=time.sleep):
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.deadline = self.clock()
+        self.nb_ticks = 0
+        self.nb_skipped = 0
+
+    @property
+    def next_deadline(self):
+        return self.deadline + self.period
+
+    def wait(self):
+        deadline = self.next_deadline
+        now = self.clock()
+        if now < deadline:
+            self.sleep(deadline - now)
+            now = self.clock()
+        lateness = now - deadline
+        self.deadline = deadline
+        if lateness >= self.period:
+            missed = int(lateness // self.period)
+            self.deadline += missed*self.period
+            self.nb_skipped += missed
+        self.nb_ticks += 1
+        return lateness, [0]
+
+
+class BurstRule:
+    '''
+    Condition on the values of a row, of the form "COLUMN>VALUE" or "COLUMN<VALUE" (threshold on the value),
+    "change(COLUMN)>VALUE" (absolute difference with the previous row) or "drop(COLUMN)>VALUE" (decrease since the
+    previous row). The column may contain wildcards (e.g. frequency_core_*), the rule being met as soon as one of the
+    matching columns meets it.
+    '''
+    regex = re.compile(r'^\s*(?:(change|drop)\(([^<>]+)\)|([^<>]+?))\s*([<>])\s*([^<>]+?)\s*$')
+
+    def __init__(self, string):
+        match = self.regex.match(string)
+        if match is None:
+            raise ValueError('Expected a rule of the form COLUMN>VALUE, change(COLUMN)>VALUE or drop(COLUMN)>VALUE, '
+                             'got "%s"' % string)
+        self.string = string
+        self.kind = match.group(1) or 'value'
+        self.pattern = match.group(2) or match.group(3)
+        self.operator = match.group(4)
+        self.threshold = float(match.group(5))
+        self.indices = []
+
+    def bind(self, header):
+        '''
+        Find the columns of the rows given to is_met.
+        '''
+        self.indices = [i for i, col in enumerate(header) if fnmatch.fnmatchcase(col, self.pattern)]
+        if len(self.indices) == 0:
+            raise ValueError('No column matches the rule "%s"' % self.string)
+
+    def is_met(self, row, previous=None):
+        for i in self.indices:
+            if self.kind == 'value':
+                value = row[i]
+            elif previous is None:
+                continue
+            elif self.kind == 'change':
+                value = abs(row[i] - previous[i])
+            else:
+                value = previous[i] - row[i]
+            # the comparisons with NaN are false
+            if value > self.threshold if self.operator == '>' else value < self.threshold:
+                return True
+        return False
+
+
+class BurstPolicy:
+    '''
+    Adaptive sampling: when any of the rules is met, the rows are written every interval seconds for at least hold
+    rows, then the period is multiplied by decay at each row until it is back to the base period.
+    If pre_trigger is positive, the measures are taken every interval seconds all the time, but only one row per
+    period is written: the pre_trigger last measures not written are kept in memory and written as soon as a rule is
+    met, to show what led to it.
+    '''
+    def __init__(self, rules, interval=0.1, hold=10, decay=2, pre_trigger=0):
+        if decay <= 1:
+            raise ValueError('The decay of the period has to be greater than 1, got %s' % decay)
+        self.rules = [rule if isinstance(rule, BurstRule) else BurstRule(rule) for rule in rules]
+        self.interval = interval
+        self.hold = hold
+        self.decay = decay
+        self.buffer = deque(maxlen=pre_trigger)
+        self.base_period = None
+        self.write_period = None
+        self.next_write = float('-inf')
+        self.previous = None
+        self.remaining = 0
+        self.bursting = False
+        self.nb_bursts = 0
+
+    def bind(self, header, base_period):
+        for rule in self.rules:
+            rule.bind(header)
+        self.base_period = self.write_period = base_period
+
+    @property
+    def period(self):
+        '''
+        Period until the next measure.
+        '''
+        return self.interval if self.buffer.maxlen > 0 else self.write_period
+
+    def update(self, row, now):
+        '''
+        Take a new row, measured at the given instant of the monotonic clock, and return the rows to write.
+        '''
+        triggered = any(rule.is_met(row, self.previous) for rule in self.rules)
+        self.previous = row
+        rows = []
+        if triggered:
+            if not self.bursting:
+                self.nb_bursts += 1
+            self.bursting = True
+            self.remaining = self.hold
+            self.write_period = self.interval
+            self.next_write = now
+            rows.extend(self.buffer)
+        elif self.buffer.maxlen > 0 and now + self.interval/2 < self.next_write:
+            self.buffer.append(row)
+            return rows
+        elif self.remaining > 0:
+            self.remaining -= 1
+        elif self.bursting:
+            self.write_period = min(self.write_period*self.decay, self.base_period)
+            self.bursting = self.write_period < self.base_period
+        # the rows kept are older than this one, they can no longer be written
+        self.buffer.clear()
+        rows.append(row)
+        self.next_write = now + self.write_period
+        return rows
+
+
+class SerialCollector:
+    '''
+    Get the values of the watchers one after the other, in the calling thread.
+    '''
+    def __init__(self, watchers):
+        self.watchers = watchers
+
+    def collect(self):
+        values = []
+        for watcher in self.watchers:
+            values.extend(watcher.sample())
+        return values
+
+    def close(self):
+        pass
+
+
+class ThreadedCollector:
+    '''
+    Get the values of all the watchers at the same instant, each watcher running in its own thread.
+    A watcher that did not return within the timeout (in seconds) gets NaN values in the row. It also gets NaN values
+    in the following rows until its pending call has returned, so a stuck sensor never piles up threads.
+    '''
+    def __init__(self, watchers, timeout=None):
         self.watchers = watchers
+        self.timeout = timeout
+        # imported here, since it takes a significant part of the startup time
+        import concurrent.futures
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(watchers)),
+                                                              thread_name_prefix='ratatouille')
+        self.pending = [None for _ in watchers]
+
+    def collect(self):
+        import concurrent.futures
+        futures = []
+        for i, watcher in enumerate(self.watchers):
+            future = self.pending[i]
+            if future is None or future.done():
+                # the result of a call that timed out is outdated, we do a new call instead
+                future = self.executor.submit(watcher.sample)
+                self.pending[i] = None
+                futures.append(future)
+            else:
+                futures.append(None)
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        values = []
+        for i, (watcher, future) in enumerate(zip(self.watchers, futures)):
+            if future is not None:
+                try:
+                    remaining = None if self.timeout is None else max(0, deadline - time.monotonic())
+                    values.extend(future.result(timeout=remaining))
+                    continue
+                except concurrent.futures.TimeoutError:
+                    self.pending[i] = future
+            values.extend([float('nan')] * watcher.nb_values)
+        return values
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class Monitor:
+    def __init__(self, watchers, output_file, time_interval, catch_up=False, parallel=False, watcher_timeout=None,
+                 periods=None, output_format='csv', flush_rows=None, flush_interval=None, fsync=False,
+                 background_io=False, instrument=False, summary_window=None, handle_signals=True,
+                 burst=None, index_file=None, index_rows=1000):
+        '''
+        The optional list periods gives a specific period for each watcher (None meaning time_interval).
+        When several periods are used, each watcher is only read at its own rate and the rows are written in long
+        format, i.e. with the columns hostname, timestamp, variable and value.
+        The output_format is one of the keys of trace_writers, the output_file has to be opened accordingly (see
+        open_output_file, the CSV formats can also be written in a compressed file). It can also be a callable
+        building the trace writer from the header, constants and categories, without output_file (which is then
+        None), e.g. functools.partial(RingBufferWriter, capacity).
+        If any of flush_rows, flush_interval, fsync or background_io is set, the rows are buffered in memory and
+        written by batches (see BufferedTraceWriter), each row being written immediately if no flush policy is given.
+        If instrument is True, the CPU time and memory usage of the collector are added to the rows and statistics on
+        each watcher are recorded (see instrumentation_summary).
+        If summary_window is given (in seconds), only the min, mean, max and 99th percentile of each column over each
+        window are written, in long format (see WindowSummary).
+        If handle_signals is False, SIGINT and SIGHUP are left untouched, the loop being only stopped by stop.
+        The optional BurstPolicy burst adapts the period to the values measured (only with a single period and
+        without summary).
+        If index_file is given (CSV format only, uncompressed), the timestamp and byte offset of one row every
+        index_rows rows are written in it, to read time ranges of the trace quickly (see TimeIndexWriter).
+        '''
+        if periods is None:
+            periods = [None for _ in watchers]
+        groups = OrderedDict()
+        for watcher, period in zip(watchers, periods):
+            groups.setdefault(time_interval if period is None else period, []).append(watcher)
+        self.periods = list(groups)
+        self.watchers = [watcher for group in groups.values() for watcher in group]
         self.time_interval = time_interval
-        self.next_watch = time.time() + self.time_interval
+        self.summary = None if summary_window is None else WindowSummary(summary_window)
+        self.long_format = len(self.periods) > 1 or self.summary is not None
+        self.burst = burst
+        if self.burst is not None and self.long_format:
+            raise ValueError('Burst sampling cannot be used with several periods or with a summary')
+        # set by stop, to wake up the scheduler
+        self.wakeup = threading.Event()
+        if self.burst is None:
+            self.scheduler = MultiRateScheduler(self.periods, catch_up=catch_up, sleep=self.wakeup.wait)
+        self.collectors = []
+        self.group_headers = []
+        for group in groups.values():
+            if parallel:
+                self.collectors.append(ThreadedCollector(group, timeout=watcher_timeout))
+            else:
+                self.collectors.append(SerialCollector(group))
+            self.group_headers.append([col for watcher in group for col in watcher.header])
+        # the /proc files shared by several watchers are read once per measure
+        self.procs = list(OrderedDict.fromkeys(w.proc for w in self.watchers if w.proc is not None))
+        # lateness: delay between the scheduled instant of the measure and the actual one
+        # collection_time: time spent to get the values of all the watchers
+        self.timing_header = ['lateness', 'collection_time']
+        self.instrument = instrument
+        if self.instrument:
+            # self_cpu_time: CPU time (user and system) used by the collector process since its start, in seconds
+            # self_rss: resident memory of the collector process, in bytes
+            self.timing_header.extend(['self_cpu_time', 'self_rss'])
+            self.process = psutil.Process()
+            for watcher in self.watchers:
+                watcher.enable_instrumentation()
+            self.start_time = time.monotonic()
         self.file = output_file
-        self.writer = csv.writer(self.file)
         self.hostname = socket.gethostname()
-        header = ['hostname', 'timestamp']
-        for watcher in self.watchers:
-            header.extend(watcher.header)
-        self.writer.writerow(header)
-        signal.signal(signal.SIGINT, self.signal_handler)
-        signal.signal(signal.SIGHUP, self.signal_handler)
+        categories = {}
+        if self.long_format:
+            header = ['hostname', 'timestamp', 'variable', 'value']
+            categories['variable'] = self.timing_header + [col for h in self.group_headers for col in h]
+            if self.summary is not None:
+                categories['variable'] = WindowSummary.variables(categories['variable'])
+        else:
+            header = ['hostname', 'timestamp', *self.timing_header, *self.group_headers[0]]
+        if self.burst is not None:
+            self.burst.bind(header, time_interval)
+            self.scheduler = AdaptiveScheduler(self.burst.period, sleep=self.wakeup.wait)
+        if isinstance(output_format, str):
+            self.writer = trace_writers[output_format](self.file, header, constants={'hostname': self.hostname},
+                                                       categories=categories)
+        else:
+            self.writer = output_format(header, constants={'hostname': self.hostname}, categories=categories)
+        if index_file is not None:
+            self.writer = TimeIndexWriter(self.writer, index_file, header, every=index_rows)
+        if flush_rows is not None or flush_interval is not None or fsync or background_io:
+            if flush_rows is None and flush_interval is None:
+                flush_rows = 1
+            self.writer = BufferedTraceWriter(self.writer, flush_rows=flush_rows, flush_interval=flush_interval,
+                                              fsync=fsync, background=background_io)
+        if handle_signals:
+            signal.signal(signal.SIGINT, self.signal_handler)
+            signal.signal(signal.SIGHUP, self.signal_handler)
         self.continue_monitoring = True
 
     def signal_handler(self, sig, frame):
-        self.file.flush()
+        # the remaining rows are written when leaving the loop, the writer may be in use at this point
         self.continue_monitoring = False
 
-    def watch(self):
-        timestamp = str(datetime.datetime.now())
-        row = [self.hostname, timestamp]
-        for watcher in self.watchers:
-            row.extend(watcher.get_values())
-        self.writer.writerow(row)
+    def stop(self):
+        '''
+        Stop the loop of start_loop from another thread, after a last measure done without waiting for its deadline.
+        '''
+        self.continue_monitoring = False
+        self.wakeup.set()
+
+    def watch(self, lateness=0.0, due=None):
+        if due is None:
+            due = range(len(self.collectors))
+        timestamp = datetime.datetime.now()
+        start = time.monotonic()
+        for proc in self.procs:
+            proc.invalidate()
+        values = [self.collectors[i].collect() for i in due]
+        timings = [lateness, time.monotonic() - start]
+        if self.instrument:
+            cpu_times = self.process.cpu_times()
+            timings.extend([cpu_times.user + cpu_times.system, self.process.memory_info().rss])
+        if not self.long_format:
+            row = [self.hostname, timestamp, *timings, *values[0]]
+            if self.burst is None:
+                self.writer.writerow(row)
+            else:
+                self.writer.writerows(self.burst.update(row, start))
+                self.scheduler.period = self.burst.period
+            return
+        rows = [[self.hostname, timestamp, col, val] for col, val in zip(self.timing_header, timings)]
+        for i, group_values in zip(due, values):
+            rows.extend([self.hostname, timestamp, col, val] for col, val in zip(self.group_headers[i], group_values))
+        if self.summary is not None:
+            rows = self.summary.add(rows)
+            if len(rows) == 0:
+                return
+        self.writer.writerows(rows)
 
     def start_loop(self):
-        while self.continue_monitoring:
-            sleep_time = self.next_watch - time.time()
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-            self.next_watch = time.time() + self.time_interval
-            self.watch()
+        while True:
+            lateness, due = self.scheduler.wait()
+            # a last measure is done after the stop
+            stopping = not self.continue_monitoring
+            self.watch(lateness, due)
+            if stopping:
+                break
+        for collector in self.collectors:
+            collector.close()
+        if self.summary is not None:
+            self.writer.writerows(self.summary.flush())
+        self.writer.close()
+        if self.instrument:
+            sys.stderr.write(self.instrumentation_summary())
+
+    def instrumentation_summary(self):
+        '''
+        Return a textual summary of the overhead of the collector: statistics on the calls to get_values of each
+        watcher and the CPU time and memory used by the process.
+        '''
+        lines = []
+        for watcher in self.watchers:
+            summary = watcher.instrumentation.summary()
+            if len(lines) == 0:
+                lines.append('%-16s' % 'watcher' + ''.join('%14s' % key for key in summary))
+            lines.append('%-16s' % type(watcher).__name__ + ''.join('%14.1f' % val for val in summary.values()))
+        cpu_times = self.process.cpu_times()
+        cpu_time = cpu_times.user + cpu_times.system
+        duration = time.monotonic() - self.start_time
+        lines.append('collector CPU time: %.3f seconds (%.3f%% of a core), resident memory: %.1f MB' % (
+                     cpu_time, cpu_time / duration * 100, self.process.memory_info().rss * 1e-6))
+        return '\n'.join(lines) + '\n'
 
 monitor_classes = {
     'cpu_stats': CPUStats,
@@ -314,13 +1684,77 @@ monitor_classes = {
     'cpu_freq': CPUFreq,
     'cpu_power': CPUPower,
     'cpu_load': CPULoad,
+    'cpu_core_load': CPUCoreLoad,
     'network': Network,
+    'network_packets': NetworkPackets,
+    'disk_io': DiskIO,
     'fan_speed': FanSpeed,
+    'cgroup': CgroupWatcher,
+    'process_tree': ProcessTree,
 }
 
 
+class Sampler:
+    '''
+    Collect the given targets (keys of monitor_classes) every interval seconds from a background thread of the
+    current process, keeping the last capacity rows in memory (see RingBufferWriter). Nothing is written on disk and
+    no signal handler is installed. A first measure is taken at the start and a last one at the stop, which also
+    closes the watchers:
+        with Sampler(['cpu_freq', 'cpu_power'], interval=0.05) as sampler:
+            run_benchmark()
+        df = sampler.to_dataframe()
+    '''
+    def __init__(self, targets, interval=1, capacity=100000, persistent=True, parallel=False, watcher_timeout=None):
+        watchers = []
+        for target in targets:
+            mon = monitor_classes[target]
+            watchers.append(mon(persistent=True) if persistent and mon.supports_persistent_files else mon())
+        self.monitor = Monitor(watchers, None, interval, parallel=parallel, watcher_timeout=watcher_timeout,
+                               output_format=functools.partial(RingBufferWriter, capacity), handle_signals=False)
+        self.buffer = self.monitor.writer
+        self.thread = None
+
+    def start(self):
+        self.monitor.watch()
+        self.thread = threading.Thread(target=self.monitor.start_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.monitor.stop()
+            self.thread.join()
+            self.thread = None
+        for watcher in self.monitor.watchers:
+            watcher.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def to_array(self):
+        '''
+        Return the rows kept as an array of float64, without the hostname (see RingBufferWriter.to_array).
+        '''
+        return self.buffer.to_array()
+
+    def to_dataframe(self):
+        return self.buffer.to_dataframe()
+
+    @property
+    def columns(self):
+        return self.buffer.columns
+
+
 class Drawer:
-    def __init__(self, input_file):
+    def __init__(self, input_file, columns=None, start=None, end=None, cache=False):
+        '''
+        Load the given trace. If columns is given, only these columns are loaded (plus the timestamps), and if start
+        or end is given, only the rows in this time range. If cache is True, the parsed columns of a CSV trace are
+        kept in a sidecar binary file to speed up the next loads (see read_trace).
+        '''
         try:
             import pandas
         except ImportError:
@@ -329,39 +1763,111 @@ class Drawer:
             """
             raise RatatouilleDependencyError(msg)
         self.input_file = input_file
-        self.data = pandas.read_csv(input_file)
-        self.data.timestamp = pandas.to_datetime(self.data.timestamp)
+        long_format = False
+        if isinstance(input_file, str):
+            header = read_trace_header(input_file)
+            long_format = 'variable' in header and 'value' in header
+        file_columns = columns
+        if columns is not None and not long_format:
+            file_columns = ['timestamp'] + [col for col in columns if col != 'timestamp']
+        self.data = read_trace(input_file, None if long_format else file_columns, start=start, end=end, cache=cache)
+        if 'variable' in self.data.columns and 'value' in self.data.columns:
+            # long format, as written when the targets have different periods
+            if columns is not None:
+                self.data = self.data[self.data['variable'].isin(columns)]
+            self.data = self.data.pivot_table(index='timestamp', columns='variable', values='value',
+                                              observed=True).reset_index()
+            self.data.columns.name = None
+        self.data['timestamp'] = pandas.to_datetime(self.data['timestamp'])
+
+    @staticmethod
+    def find_segments(timestamps):
+        '''
+        Return, for each of the given (sorted) timestamps, the index of the segment it belongs to. A new segment starts
+        after each gap larger than ten times the median time step (e.g. when the monitoring was stopped).
+        '''
+        import numpy
+        timestamps = numpy.asarray(timestamps)
+        if len(timestamps) < 2:
+            return numpy.zeros(len(timestamps), dtype=int)
+        diffs = numpy.diff(timestamps)
+        time_step = numpy.median(diffs)
+        return numpy.concatenate([[0], numpy.cumsum(diffs > time_step * 10)])
 
-    def create_plot(self, columns):
+    @staticmethod
+    def downsample(data, max_points):
+        '''
+        Aggregate the given data (columns timestamp, segment and the values) in at most max_points time buckets,
+        never mixing two segments in a bucket.
+        Return the mean, min and max of each column in each bucket, as three DataFrames indexed by the bucket, the
+        timestamp of a bucket being the mean of its timestamps in all three.
+        '''
+        import numpy
+        import pandas
+        timestamps = data['timestamp'].values
+        start = timestamps.min()
+        width = (timestamps.max() - start) / max_points
+        if width > numpy.timedelta64(0):
+            # the last timestamp would be alone in its bucket
+            buckets = numpy.minimum(((timestamps - start) / width).astype(int), max_points - 1)
+        else:
+            buckets = numpy.zeros(len(timestamps), dtype=int)
+        keys = [buckets, data['segment'].values]
+        grouped = data.drop(columns=['timestamp']).groupby(keys, sort=True)
+        # the mean of a datetime column is dropped by pandas < 2, so it is computed on the nanoseconds
+        nanoseconds = pandas.Series(timestamps.astype('datetime64[ns]').astype('int64'))
+        bucket_timestamps = pandas.to_datetime(nanoseconds.groupby(keys, sort=True).mean().round().astype('int64'))
+        position = list(data.columns).index('timestamp')
+        results = []
+        for aggregated in [grouped.mean(), grouped.min(), grouped.max()]:
+            aggregated.insert(position, 'timestamp', bucket_timestamps.values)
+            results.append(aggregated)
+        return tuple(results)
+
+    def create_plot(self, columns, max_points=None, width=6.4, dpi=100):
+        '''
+        Plot the given columns (all of them if the list is empty), one facet per column.
+        If a column has more rows than there are pixels in its facet (computed from the width in inches and the
+        dpi), it is aggregated in time buckets: the line shows the mean of each bucket and the ribbon its min and max.
+        The number of buckets can also be given with max_points (0 to disable the aggregation).
+        '''
         for col in columns:
             if col not in self.data.columns:
                 raise ValueError('No column "%s" in the data' % col)
         try:
-            from plotnine import ggplot, theme_bw, aes, geom_line, expand_limits, scale_x_datetime, ylab, facet_wrap, theme
+            from plotnine import ggplot, theme_bw, aes, geom_line, geom_ribbon, expand_limits, scale_x_datetime, ylab, facet_wrap, theme
             from mizani.formatters import date_format
         except ImportError:
             msg = """Package 'plotnine' is required for the plot functionnality.
             Try installing it with 'pip install plotnine'.
             """
             raise RatatouilleDependencyError(msg)
-        data = self.data.copy()
-        if len(columns) > 0:
-            data = data[['timestamp'] + columns]
-        else:
-            if 'hostname' in data:
-                data.drop('hostname', axis=1, inplace=True)
-        data['time_diff'] = data['timestamp'][1:].reset_index(drop=True) - data['timestamp'][:-1].reset_index(drop=True)
-        time_step = data['time_diff'].median()
-        breakpoints = list(data[data['time_diff'] > time_step * 10].timestamp)
-        breakpoints = [data['timestamp'].min(), *breakpoints, data['timestamp'].max()]
-        data = data.drop('time_diff', axis=1).melt('timestamp')
         import pandas
         if len(columns) > 0:
-            data['variable'] = pandas.Categorical(data['variable'], categories=columns)
-        plot = ggplot() + theme_bw()
-        for min_t, max_t in zip(breakpoints[:-1], breakpoints[1:]):
-            tmp = data[(data['timestamp'] > min_t) & (data['timestamp'] < max_t)]
-            plot += geom_line(tmp, aes(x='timestamp', y='value', color='variable'), show_legend=False)
+            data = self.data[['timestamp'] + columns]
+        else:
+            data = self.data.drop(columns=[col for col in ['hostname'] if col in self.data])
+            columns = [col for col in data.columns if col != 'timestamp']
+        data = data.assign(segment=self.find_segments(data['timestamp'].values))
+        if max_points is None:
+            # facet_wrap uses a square-ish grid of facets
+            nb_facet_columns = math.ceil(math.sqrt(len(columns)))
+            max_points = int(width * dpi / nb_facet_columns)
+        aggregated = max_points > 0 and len(data) > max_points
+        if aggregated:
+            means, mins, maxs = self.downsample(data, max_points)
+            data = means.melt(['timestamp', 'segment'])
+            data['ymin'] = mins.drop(columns=['timestamp', 'segment']).values.ravel(order='F')
+            data['ymax'] = maxs.drop(columns=['timestamp', 'segment']).values.ravel(order='F')
+        else:
+            data = data.melt(['timestamp', 'segment'])
+        data = data.dropna(subset=['value'])
+        data['variable'] = pandas.Categorical(data['variable'], categories=columns)
+        plot = ggplot(data, aes(x='timestamp', y='value', color='variable', group='segment')) + theme_bw()
+        if aggregated:
+            plot += geom_ribbon(aes(ymin='ymin', ymax='ymax', fill='variable'), alpha=0.3, color='none',
+                                show_legend=False)
+        plot += geom_line(show_legend=False)
         plot += facet_wrap(['variable'], scales='free')
         timedelta = self.data.timestamp.max() - self.data.timestamp.min()
         if timedelta.days > 2:
@@ -372,13 +1878,119 @@ class Drawer:
         return plot
 
 
-def merge_files(input_files, output_file):
-    try:
-        import pandas
-    except ImportError:
-        msg = """Package 'pandas' is required for the merge functionnality.
-        Try installing it with 'pip install pandas'.
-        """
-        raise RatatouilleDependencyError(msg)
-    dataframes = [pandas.read_csv(f) for f in input_files]
-    pandas.concat(dataframes, sort=False).to_csv(output_file, index=False)
+def selfbench(targets, nb_samples=100, time_interval=0.01, persistent=False, proc_backend=False):
+    '''
+    Measure the overhead of each of the given targets (keys of monitor_classes), sampled alone nb_samples times with
+    the given period. Return a dictionary mapping each available target to the instrumentation summary of its
+    watcher, completed with the time taken to create the watcher.
+    If proc_backend is True, the watchers supporting it read /proc directly (see ProcFS).
+    '''
+    results = OrderedDict()
+    for target in targets:
+        cls = monitor_classes[target]
+        kwargs = {}
+        if persistent and cls.supports_persistent_files:
+            kwargs['persistent'] = True
+        if proc_backend and cls.supports_proc:
+            kwargs['proc'] = ProcFS()
+        start = time.perf_counter()
+        try:
+            watcher = cls(**kwargs)
+        except (RatatouillePortabilityError, RatatouilleDependencyError) as e:
+            sys.stderr.write('WARNING: %s\n' % e)
+            continue
+        init_time = time.perf_counter() - start
+        watcher.enable_instrumentation()
+        scheduler = Scheduler(time_interval)
+        for _ in range(nb_samples):
+            scheduler.wait()
+            watcher.sample()
+        watcher.close()
+        if 'proc' in kwargs:
+            kwargs['proc'].close()
+        summary = watcher.instrumentation.summary()
+        summary['init_ms'] = init_time * 1e3
+        results[target] = summary
+    return results
+
+
+def prefetch(iterable, semaphore, maxsize=4):
+    '''
+    Iterate on the given iterable in a background thread, at most maxsize elements ahead of the consumer.
+    The semaphore bounds the number of threads computing an element at the same time.
+    '''
+    items = queue.Queue(maxsize=maxsize)
+    end = object()
+
+    def produce():
+        try:
+            iterator = iter(iterable)
+            while True:
+                with semaphore:
+                    item = next(iterator, end)
+                items.put(item)
+                if item is end:
+                    break
+        except Exception as e:
+            items.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is end:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def merge_files(input_files, output_file, output_format='csv', jobs=1, compression=None, start=None, end=None):
+    '''
+    Merge the given traces into a single one, ordered by timestamp.
+    The inputs are streamed and merged with a k-way merge, so the memory usage does not depend on their length. The
+    columns of the output are the union of the columns of the inputs, the missing values being left empty (NaN in
+    the binary format). If jobs is greater than 1, the inputs are read in background threads, at most jobs at a time.
+    The output is compressed with the given compression, if any (see open_output_file).
+    If start or end is given, only the rows in this time range are merged, the inputs being read from their time
+    index if they have one (see TraceReader).
+    '''
+    # with hundreds of inputs, the buffered chunks dominate the memory usage
+    readers = [TraceReader(filename, chunk_size=100, start=start, end=end) for filename in input_files]
+    header = list(OrderedDict.fromkeys(col for reader in readers for col in reader.header))
+    if 'timestamp' not in header:
+        raise ValueError('No column "timestamp" in the data')
+    binary = output_format == 'binary'
+    categories = {}
+    if binary:
+        for col in STRING_COLUMNS:
+            if col in header:
+                categories[col] = sorted(set().union(*(reader.distinct_values(col) for reader in readers
+                                                       if col in reader.header)))
+    missing = float('nan') if binary else ''
+    semaphore = threading.Semaphore(jobs)
+
+    def aligned_rows(reader):
+        positions = [header.index(col) for col in reader.header]
+        to_float = [binary and col not in categories and col != 'timestamp' for col in reader.header]
+        chunks = reader.chunks()
+        if jobs > 1:
+            chunks = prefetch(chunks, semaphore)
+        for chunk in chunks:
+            for row in chunk:
+                new_row = [missing] * len(header)
+                for pos, convert, value in zip(positions, to_float, row):
+                    if convert and isinstance(value, str):
+                        value = float(value) if value != '' else missing
+                    new_row[pos] = value
+                yield new_row
+
+    timestamp_index = header.index('timestamp')
+    rows = heapq.merge(*[aligned_rows(reader) for reader in readers], key=lambda row: row[timestamp_index])
+    with open_output_file(output_file, output_format, compression) as f:
+        writer = trace_writers[output_format](f, header, categories=categories)
+        while True:
+            chunk = list(itertools.islice(rows, 1000))
+            if len(chunk) == 0:
+                break
+            writer.writerows(chunk)
+        writer.close()
@@ -0,0 +1,869 @@
+import csv
+import datetime
+import io
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from array import array
+
+
+# Naive local timestamps (as written in the CSV files) are stored as a number of seconds since this date
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def timestamp_to_seconds(timestamp):
+    return (timestamp - EPOCH).total_seconds()
+
+
+class CSVTraceWriter:
+    '''
+    Write the rows as CSV, the timestamps being written in ISO format.
+    The constants and categories are only used by the binary format, they are written as is in the rows.
+    '''
+    file_mode = 'w'
+
+    def __init__(self, file, header, constants=None, categories=None):
+        self.file = file
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+
+
+# First line of the CSV traces written by DeltaCSVTraceWriter
+DELTA_MARKER = '#ratatouille-delta'
+
+
+class DeltaCSVTraceWriter(CSVTraceWriter):
+    '''
+    Write the rows as CSV, each value equal to the one of the previous row being left empty and each timestamp being
+    written as the number of microseconds elapsed since the previous one (e.g. "+1000000"), the first one being
+    written in ISO format. The header is preceded by the line DELTA_MARKER.
+    Since the empty fields mean "unchanged", the missing values are written as "nan".
+    The constants and categories are ignored, the constant columns taking no space after the first row.
+    '''
+    def __init__(self, file, header, constants=None, categories=None):
+        file.write(DELTA_MARKER + '\n')
+        super().__init__(file, header)
+        self.timestamp_index = header.index('timestamp') if 'timestamp' in header else None
+        self.previous = None
+        self.previous_timestamp = None
+
+    def encode(self, row):
+        values = ['nan' if value is None or value == '' else str(value) for value in row]
+        encoded = values if self.previous is None else [
+            '' if value == previous else value for value, previous in zip(values, self.previous)]
+        if self.timestamp_index is not None:
+            timestamp = row[self.timestamp_index]
+            if isinstance(timestamp, str):
+                timestamp = datetime.datetime.fromisoformat(timestamp)
+            if self.previous_timestamp is not None and encoded[self.timestamp_index] != '':
+                delta = (timestamp - self.previous_timestamp) // datetime.timedelta(microseconds=1)
+                encoded[self.timestamp_index] = '+%d' % delta
+            self.previous_timestamp = timestamp
+        self.previous = values
+        return encoded
+
+    def writerow(self, row):
+        self.writer.writerow(self.encode(row))
+
+    def writerows(self, rows):
+        self.writer.writerows(self.encode(row) for row in rows)
+
+
+def decode_delta_rows(rows, header):
+    '''
+    Decode the rows (lists of strings) written by DeltaCSVTraceWriter, yielding them in the plain CSV representation.
+    '''
+    timestamp_index = header.index('timestamp') if 'timestamp' in header else None
+    previous = None
+    timestamp = None
+    for row in rows:
+        if timestamp_index is not None:
+            encoded = row[timestamp_index]
+            if encoded.startswith('+'):
+                timestamp += datetime.timedelta(microseconds=int(encoded[1:]))
+                row[timestamp_index] = str(timestamp)
+            elif encoded != '':
+                timestamp = datetime.datetime.fromisoformat(encoded)
+        if previous is not None:
+            row = [prev if value == '' else value for value, prev in zip(row, previous)]
+        previous = row
+        yield row
+
+
+class RecordEncoder:
+    '''
+    Conversion of the rows into records of floats: the constant columns are dropped, the timestamps are converted to
+    a number of seconds since EPOCH and the values of the columns having categories are replaced by their index, the
+    missing values (None, NaN or empty strings, e.g. in the rows of a wide trace merged with a long one) being NaN.
+    '''
+    def __init__(self, header, constants=None, categories=None):
+        self.constants = constants or {}
+        self.categories = categories or {}
+        self.columns = [col for col in header if col not in self.constants]
+        self.indices = [header.index(col) for col in self.columns]
+        self.timestamp_index = self.columns.index('timestamp') if 'timestamp' in self.columns else None
+        self.category_codes = {self.columns.index(col): {value: code for code, value in enumerate(values)}
+                               for col, values in self.categories.items()}
+
+    def schema(self, metadata=None):
+        return {
+            'columns': self.columns,
+            'constants': self.constants,
+            'categories': self.categories,
+            'metadata': metadata or {},
+        }
+
+    def encode(self, row):
+        record = [row[i] for i in self.indices]
+        if self.timestamp_index is not None:
+            timestamp = record[self.timestamp_index]
+            if isinstance(timestamp, datetime.datetime):
+                record[self.timestamp_index] = timestamp_to_seconds(timestamp)
+            elif isinstance(timestamp, str):
+                record[self.timestamp_index] = timestamp_to_seconds(datetime.datetime.fromisoformat(timestamp))
+        for i, codes in self.category_codes.items():
+            value = record[i]
+            if value is None or value == '' or value != value:
+                record[i] = float('nan')
+            else:
+                record[i] = codes[value]
+        return record
+
+
+class BinaryTraceWriter(RecordEncoder):
+    '''
+    Write the rows as fixed-width records of float64 (little endian), after a header block describing the schema.
+
+    File layout:
+        - the 8 bytes magic number MAGIC
+        - the length of the schema, as a little endian uint32
+        - the schema, in JSON, padded with spaces so that the records are aligned on 8 bytes
+        - the records, one float64 per stored column
+
+    The schema is a dictionary with the following keys:
+        - columns: the names of the stored columns, in the order of the records
+        - constants: the columns having the same value for every row (e.g. the hostname), not stored in the records
+        - categories: for the columns having string values (e.g. the variable in long format), the list of all the
+          possible values, the records containing the index of the value in this list
+        - metadata: free-form information about the trace (e.g. the source of a cache file)
+    The timestamps are stored as a number of seconds since EPOCH, in local time.
+    '''
+    file_mode = 'wb'
+    MAGIC = b'RATABIN\x01'
+
+    def __init__(self, file, header, constants=None, categories=None, metadata=None):
+        super().__init__(header, constants, categories)
+        self.file = file
+        schema = json.dumps(self.schema(metadata)).encode()
+        prefix_size = len(self.MAGIC) + 4
+        schema += b' ' * (-(prefix_size + len(schema)) % 8)
+        self.file.write(self.MAGIC + struct.pack('<I', len(schema)) + schema)
+
+    def writerow(self, row):
+        self.file.write(array('d', self.encode(row)).tobytes())
+
+    def writerows(self, rows):
+        records = array('d')
+        for row in rows:
+            records.extend(self.encode(row))
+        self.file.write(records.tobytes())
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+
+
+class RingBufferWriter(RecordEncoder):
+    '''
+    Keep the last rows in memory, as records of float64 (see RecordEncoder) in a preallocated NumPy array of the
+    given capacity, the oldest rows being overwritten once it is full. It is given to a Monitor as a callable
+    building the writer, e.g. functools.partial(RingBufferWriter, capacity).
+    '''
+    def __init__(self, capacity, header, constants=None, categories=None):
+        import numpy
+        super().__init__(header, constants, categories)
+        self.records = numpy.full((capacity, len(self.columns)), numpy.nan)
+        self.nb_rows = 0
+
+    def writerow(self, row):
+        self.records[self.nb_rows % len(self.records)] = self.encode(row)
+        self.nb_rows += 1
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def to_array(self):
+        '''
+        Return the records of the rows kept, in chronological order: a view of the buffer if it has not been filled,
+        a copy otherwise.
+        '''
+        import numpy
+        capacity = len(self.records)
+        if self.nb_rows <= capacity:
+            return self.records[:self.nb_rows]
+        return numpy.roll(self.records, -(self.nb_rows % capacity), axis=0)
+
+    def to_dataframe(self):
+        return records_to_dataframe(self.schema(), self.to_array())
+
+
+class BufferedTraceWriter:
+    '''
+    Keep the rows in memory and hand them by batches to the given trace writer, either when flush_rows rows are
+    buffered or when the oldest buffered row is older than flush_interval seconds.
+    After each batch, the file is flushed and, if fsync is True, synced to the disk, so a hard kill loses at most one
+    batch of rows.
+    If background is True, the batches are written by a dedicated thread, so the thread producing the rows never waits
+    for the storage. When the writing thread lags behind, the rows keep accumulating in the buffer until it catches up.
+    '''
+    def __init__(self, writer, flush_rows=1000, flush_interval=None, fsync=False, background=False, max_pending=16):
+        self.writer = writer
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer = []
+        self.first_row_time = None
+        if background:
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self.write_loop, name='ratatouille-writer', daemon=True)
+            self.thread.start()
+        else:
+            self.queue = None
+            self.thread = None
+
+    def writerow(self, row):
+        if self.first_row_time is None:
+            self.first_row_time = time.monotonic()
+        self.buffer.append(row)
+        if self.must_flush():
+            self.flush()
+
+    def writerows(self, rows):
+        if self.first_row_time is None:
+            self.first_row_time = time.monotonic()
+        self.buffer.extend(rows)
+        if self.must_flush():
+            self.flush()
+
+    def must_flush(self):
+        if self.flush_rows is not None and len(self.buffer) >= self.flush_rows:
+            return True
+        return self.flush_interval is not None and time.monotonic() - self.first_row_time >= self.flush_interval
+
+    def flush(self, block=False):
+        if len(self.buffer) == 0:
+            return
+        batch = self.buffer
+        if self.queue is not None:
+            try:
+                self.queue.put(batch, block=block)
+            except queue.Full:
+                return
+        else:
+            self.write_batch(batch)
+        self.buffer = []
+        self.first_row_time = None
+
+    def write_batch(self, batch):
+        self.writer.writerows(batch)
+        self.writer.flush()
+        if self.fsync:
+            os.fsync(self.writer.file.fileno())
+
+    def write_loop(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            self.write_batch(batch)
+
+    def close(self):
+        self.flush(block=True)
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.writer.close()
+
+
+class TimeIndexWriter:
+    '''
+    Wrap a CSV trace writer of an uncompressed file, writing in index_file the timestamp and byte offset of one row
+    every every rows (see index_filename). The rows have to be written in chronological order.
+    '''
+    def __init__(self, writer, index_file, header, every=1000):
+        self.writer = writer
+        self.file = writer.file
+        self.index_file = index_file
+        self.index = csv.writer(index_file)
+        self.timestamp_index = header.index('timestamp')
+        self.every = every
+        self.nb_rows = 0
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        start = 0
+        while start < len(rows):
+            if self.nb_rows % self.every == 0:
+                self.index.writerow([rows[start][self.timestamp_index], self.file.tell()])
+            size = min(len(rows) - start, self.every - self.nb_rows % self.every)
+            self.writer.writerows(rows[start:start+size])
+            self.nb_rows += size
+            start += size
+
+    def flush(self):
+        self.writer.flush()
+        self.index_file.flush()
+
+    def close(self):
+        self.writer.close()
+        self.index_file.flush()
+
+
+trace_writers = {
+    'csv': CSVTraceWriter,
+    'csv_delta': DeltaCSVTraceWriter,
+    'binary': BinaryTraceWriter,
+}
+
+
+# the compression modules are only imported when needed, to keep the startup fast
+def open_zstd(filename, mode, **kwargs):
+    import zstandard
+    return zstandard.open(filename, mode, **kwargs)
+
+
+def open_lz4(filename, mode, **kwargs):
+    import lz4.frame
+    return lz4.frame.open(filename, mode, **kwargs)
+
+
+def open_gzip(filename, mode, **kwargs):
+    import gzip
+    return gzip.open(filename, mode, **kwargs)
+
+
+def open_bz2(filename, mode, **kwargs):
+    import bz2
+    return bz2.open(filename, mode, **kwargs)
+
+
+def open_xz(filename, mode, **kwargs):
+    import lzma
+    return lzma.open(filename, mode, **kwargs)
+
+
+# For each compression of the CSV traces, the magic number of the compressed files and the function opening them
+compressions = {
+    'zstd': (b'\x28\xb5\x2f\xfd', open_zstd),
+    'lz4': (b'\x04\x22\x4d\x18', open_lz4),
+    'gzip': (b'\x1f\x8b', open_gzip),
+    'bz2': (b'BZh', open_bz2),
+    'xz': (b'\xfd7zXZ\x00', open_xz),
+}
+
+
+def default_compression():
+    '''
+    Return the fastest available compression: zstd or lz4 if their package is installed, gzip otherwise.
+    '''
+    for compression, module in [('zstd', 'zstandard'), ('lz4', 'lz4.frame')]:
+        try:
+            __import__(module)
+            return compression
+        except ImportError:
+            pass
+    return 'gzip'
+
+
+def detect_compression(filename):
+    '''
+    Return the compression of the given file, found with its magic number, or None if it is not compressed.
+    '''
+    with open(filename, 'rb') as f:
+        start = f.read(8)
+    for compression, (magic, _) in compressions.items():
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+def open_compressed(filename, compression, mode, **kwargs):
+    '''
+    Open the given file with the given compression (a key of compressions), like open would do.
+    Raise ImportError if the package needed by the compression is not installed.
+    '''
+    return compressions[compression][1](filename, mode, **kwargs)
+
+
+def open_output_file(filename, output_format, compression=None):
+    '''
+    Open the given file to write a trace of the given format (a key of trace_writers), compressed with the given
+    compression if it is not None ("auto" meaning the default_compression).
+    '''
+    mode = trace_writers[output_format].file_mode
+    if compression is None:
+        return open(filename, mode)
+    if 'b' in mode:
+        raise ValueError('The %s format cannot be compressed' % output_format)
+    if compression == 'auto':
+        compression = default_compression()
+    return open_compressed(filename, compression, mode + 't')
+
+
+def open_csv_trace(filename):
+    '''
+    Open the given CSV trace as text, decompressing it on the fly if needed.
+    '''
+    compression = detect_compression(filename)
+    if compression is None:
+        return open(filename, newline='')
+    return open_compressed(filename, compression, 'rt', newline='')
+
+
+def is_binary_trace(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(BinaryTraceWriter.MAGIC)) == BinaryTraceWriter.MAGIC
+
+
+def read_binary_schema(filename):
+    '''
+    Return the schema of the given binary trace, together with the offset of its first record.
+    '''
+    with open(filename, 'rb') as f:
+        magic = f.read(len(BinaryTraceWriter.MAGIC))
+        if magic != BinaryTraceWriter.MAGIC:
+            raise ValueError('File %s is not a binary trace' % filename)
+        schema_size, = struct.unpack('<I', f.read(4))
+        schema = json.loads(f.read(schema_size).decode())
+    return schema, len(BinaryTraceWriter.MAGIC) + 4 + schema_size
+
+
+def map_binary_trace(filename):
+    '''
+    Memory-map the records of the given binary trace, as a 2D float64 array (one row per record).
+    An incomplete last record (e.g. if the collection was killed) is ignored.
+    '''
+    import numpy
+    schema, offset = read_binary_schema(filename)
+    nb_columns = len(schema['columns'])
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        nb_rows = (f.tell() - offset) // (8*nb_columns)
+    if nb_rows == 0:
+        return schema, numpy.empty((0, nb_columns), dtype='<f8')
+    records = numpy.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=(nb_rows, nb_columns))
+    return schema, records
+
+
+def to_seconds(timestamp):
+    '''
+    Convert the given timestamp (datetime or string) to a number of seconds since EPOCH.
+    '''
+    import pandas
+    return timestamp_to_seconds(pandas.Timestamp(timestamp).to_pydatetime())
+
+
+def read_binary_trace(filename, columns=None, start=None, end=None):
+    '''
+    Load the given binary trace as a DataFrame, the numerical columns being views of the memory-mapped records.
+    If columns is given, only these columns are loaded. If start or end is given, only the rows in this time range
+    are loaded, found with a binary search on the timestamps.
+    '''
+    import numpy
+    schema, records = map_binary_trace(filename)
+    if start is not None or end is not None:
+        timestamps = records[:, schema['columns'].index('timestamp')]
+        first = 0 if start is None else numpy.searchsorted(timestamps, to_seconds(start), side='left')
+        last = len(records) if end is None else numpy.searchsorted(timestamps, to_seconds(end), side='right')
+        records = records[first:last]
+    return records_to_dataframe(schema, records, columns)
+
+
+def records_to_dataframe(schema, records, columns=None):
+    '''
+    Return a DataFrame of the given records of float64 (one row per record), described by the given schema (see
+    BinaryTraceWriter). If columns is given, only these columns are kept.
+    '''
+    import numpy
+    import pandas
+    data = {}
+    for col, value in schema['constants'].items():
+        if columns is None or col in columns:
+            data[col] = pandas.Series([value]*len(records), dtype='category')
+    for i, col in enumerate(schema['columns']):
+        if columns is not None and col not in columns:
+            continue
+        values = records[:, i]
+        if col == 'timestamp':
+            # the float64 precision is of the order of the microsecond
+            values = pandas.to_datetime(values, unit='s').round('us')
+        elif col in schema['categories']:
+            # the missing values (NaN) get the code -1
+            codes = numpy.where(numpy.isnan(values), -1, values).astype(int)
+            values = pandas.Categorical.from_codes(codes, categories=schema['categories'][col])
+        data[col] = values
+    return pandas.DataFrame(data, copy=False)
+
+
+def read_csv_trace(input_file, columns=None, start=None, end=None, chunk_size=100000):
+    '''
+    Load the given CSV trace (path or file object) as a DataFrame, parsing only the given columns (all of them if
+    None). The file is parsed by chunks, the rows outside of the time range being dropped from each chunk.
+    The rows are supposed to be in chronological order: the parsing starts from the time index of the trace, if any
+    (see TimeIndexWriter), and stops after the end of the time range.
+    '''
+    import pandas
+    if columns is not None and (start is not None or end is not None) and 'timestamp' not in columns:
+        columns = ['timestamp'] + list(columns)
+    if end is not None:
+        # the rows parsed after the end of the range are wasted
+        chunk_size = min(chunk_size, 10000)
+    chunks = []
+    for chunk in iter_csv_chunks(input_file, columns, chunk_size, start=start):
+        after_end = False
+        if start is not None or end is not None:
+            timestamps = pandas.to_datetime(chunk['timestamp'])
+            mask = pandas.Series(True, index=chunk.index)
+            if start is not None:
+                mask &= timestamps >= pandas.Timestamp(start)
+            if end is not None:
+                mask &= timestamps <= pandas.Timestamp(end)
+                after_end = len(chunk) > 0 and timestamps.iloc[-1] > pandas.Timestamp(end)
+            chunk = chunk[mask]
+        chunks.append(chunk)
+        if after_end:
+            break
+    if len(chunks) == 0:
+        if isinstance(input_file, str):
+            input_file = io.StringIO(','.join(TraceReader(input_file).header))
+        return pandas.read_csv(input_file, usecols=columns, nrows=0)
+    data = pandas.concat(chunks, ignore_index=True)
+    if columns is not None:
+        data = data[[col for col in columns if col in data.columns]]
+    return data
+
+
+def iter_csv_chunks(input_file, columns, chunk_size, start=None):
+    '''
+    Parse the given CSV trace (path or file object) by chunks of DataFrame, decompressing and decoding it if needed.
+    If start is given and the trace has a time index, the rows older than start are skipped, at least in part.
+    '''
+    import pandas
+    if not isinstance(input_file, str):
+        yield from pandas.read_csv(input_file, usecols=columns, chunksize=chunk_size)
+        return
+    reader = TraceReader(input_file, chunk_size=chunk_size)
+    offset = None
+    if start is not None and not reader.delta and detect_compression(input_file) is None:
+        offset = find_start_offset(input_file, reader.header, start)
+    if offset is not None:
+        with open(input_file, newline='') as f:
+            f.seek(offset)
+            yield from pandas.read_csv(f, names=reader.header, header=None, usecols=columns, chunksize=chunk_size)
+        return
+    if not reader.delta:
+        with open_csv_trace(input_file) as f:
+            yield from pandas.read_csv(f, usecols=columns, chunksize=chunk_size)
+        return
+    # the rows are decoded in Python, then parsed again so that the types are the same as with a plain CSV
+    for chunk in reader.chunks():
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(reader.header)
+        writer.writerows(chunk)
+        text.seek(0)
+        yield pandas.read_csv(text, usecols=columns)
+
+
+def read_trace_header(filename):
+    if is_binary_trace(filename):
+        schema, _ = read_binary_schema(filename)
+        return list(schema['constants']) + schema['columns']
+    return TraceReader(filename).header
+
+
+def cache_filename(filename):
+    return filename + '.ratcache'
+
+
+def read_cache(filename):
+    '''
+    Return the cached data of the given CSV trace, or None if there is no cache or if it is outdated.
+    '''
+    stat = os.stat(filename)
+    try:
+        schema, _ = read_binary_schema(cache_filename(filename))
+        metadata = schema.get('metadata', {})
+        if metadata.get('source_size') != stat.st_size or metadata.get('source_mtime_ns') != stat.st_mtime_ns:
+            return None
+        return read_binary_trace(cache_filename(filename))
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(filename, data):
+    stat = os.stat(filename)
+    metadata = {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+    # the previous cache may still be memory-mapped, so it is replaced rather than overwritten
+    tmp_filename = cache_filename(filename) + '.tmp'
+    try:
+        write_binary_dataframe(data, tmp_filename, metadata=metadata)
+        os.replace(tmp_filename, cache_filename(filename))
+    except OSError:
+        pass
+
+
+def index_filename(filename):
+    return filename + '.ratidx'
+
+
+def read_time_index(filename):
+    '''
+    Return the entries (timestamp, byte offset) of the time index of the given CSV trace (see TimeIndexWriter), or an
+    empty list if there is none.
+    '''
+    entries = []
+    try:
+        with open(index_filename(filename), newline='') as f:
+            for row in csv.reader(f):
+                try:
+                    entries.append((datetime.datetime.fromisoformat(row[0]), int(row[1])))
+                except (ValueError, IndexError):
+                    # e.g. the last line, if the collector was killed while writing it
+                    break
+    except OSError:
+        pass
+    return entries
+
+
+def find_start_offset(filename, header, start):
+    '''
+    Return the byte offset of a row of the given uncompressed CSV trace preceding all the rows not older than start,
+    found with its time index, or None if the index cannot be used.
+    '''
+    import bisect
+    entries = read_time_index(filename)
+    position = bisect.bisect_left([timestamp for timestamp, _ in entries], parse_timestamp(start)) - 1
+    if position < 0:
+        return None
+    timestamp, offset = entries[position]
+    # the index may be outdated, e.g. if the trace was written again by another program
+    with open(filename, newline='') as f:
+        f.seek(offset)
+        row = next(csv.reader([f.readline()]), [])
+    try:
+        if datetime.datetime.fromisoformat(row[header.index('timestamp')]) != timestamp:
+            return None
+    except (ValueError, IndexError):
+        return None
+    return offset
+
+
+def parse_timestamp(timestamp):
+    '''
+    Convert the given timestamp (datetime or ISO string) to a datetime.
+    '''
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp
+    return datetime.datetime.fromisoformat(timestamp)
+
+
+def read_trace(input_file, columns=None, start=None, end=None, cache=False):
+    '''
+    Load the given trace (path or file object), written in any of the supported formats, as a DataFrame.
+    If columns is given, only these columns of the file are loaded. If start or end is given, only the rows in this
+    time range are kept.
+    If cache is True, the columns parsed from a CSV file are kept in a binary sidecar file (see cache_filename), valid
+    as long as the size and modification time of the CSV file do not change. The following loads of these columns
+    are then memory-mapped from the sidecar file instead of being parsed again. The cache is not used to load a time
+    range of a CSV trace having a time index, only the rows of this range being parsed (see read_csv_trace).
+    '''
+    import pandas
+    if not isinstance(input_file, str):
+        return read_csv_trace(input_file, columns, start, end)
+    if is_binary_trace(input_file):
+        return read_binary_trace(input_file, columns, start, end)
+    header = read_trace_header(input_file)
+    wanted = header if columns is None else [col for col in header if col in columns]
+    if not cache or ((start is not None or end is not None) and len(read_time_index(input_file)) > 0):
+        return read_csv_trace(input_file, wanted, start, end)
+    cached = read_cache(input_file)
+    cached_columns = [] if cached is None else list(cached.columns)
+    missing = [col for col in wanted if col not in cached_columns]
+    if len(missing) > 0:
+        parsed = read_csv_trace(input_file, missing)
+        if cached is None:
+            cached = parsed
+        else:
+            cached = pandas.concat([cached, parsed], axis=1)
+            cached = cached[[col for col in header if col in cached.columns]]
+        write_cache(input_file, cached)
+    data = cached[wanted]
+    if start is not None:
+        data = data[pandas.to_datetime(data['timestamp']) >= pandas.Timestamp(start)]
+    if end is not None:
+        data = data[pandas.to_datetime(data['timestamp']) <= pandas.Timestamp(end)]
+    return data.reset_index(drop=True)
+
+
+# Columns holding strings, stored as categories in the binary traces
+STRING_COLUMNS = ['hostname', 'variable']
+
+
+class TraceReader:
+    '''
+    Streaming reader of a trace, in any of the supported formats.
+    The rows are yielded by chunks, in the CSV representation of the rows: the timestamps are ISO strings and the
+    strings columns are decoded, so the memory usage does not depend on the length of the trace. The compressed and
+    delta-encoded CSV traces are decompressed and decoded on the fly.
+    If start or end is given, only the rows in this time range are yielded, the rows being supposed to be in
+    chronological order: the binary traces are searched with a binary search, the CSV traces are read from their
+    time index, if any (see TimeIndexWriter), until the end of the range.
+    '''
+    def __init__(self, filename, chunk_size=1000, start=None, end=None):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.start = None if start is None else parse_timestamp(start)
+        self.end = None if end is None else parse_timestamp(end)
+        self.delta = False
+        if is_binary_trace(filename):
+            self.schema, _ = read_binary_schema(filename)
+            self.header = list(self.schema['constants']) + self.schema['columns']
+        else:
+            self.schema = None
+            with open_csv_trace(filename) as f:
+                reader = csv.reader(f)
+                self.header = next(reader)
+                if self.header == [DELTA_MARKER]:
+                    self.delta = True
+                    self.header = next(reader)
+
+    def chunks(self):
+        if self.schema is None:
+            return self.csv_chunks()
+        return self.binary_chunks()
+
+    def csv_chunks(self):
+        offset = None
+        if self.start is not None and not self.delta and detect_compression(self.filename) is None:
+            offset = find_start_offset(self.filename, self.header, self.start)
+        with open_csv_trace(self.filename) as f:
+            reader = csv.reader(f)
+            if offset is not None:
+                f.seek(offset)
+                reader = csv.reader(f)
+            else:
+                if self.delta:
+                    next(reader)
+                next(reader)
+            if self.delta:
+                reader = decode_delta_rows(reader, self.header)
+            if self.start is not None or self.end is not None:
+                reader = self.in_range(reader, self.header.index('timestamp'))
+            while True:
+                chunk = [row for _, row in zip(range(self.chunk_size), reader)]
+                if len(chunk) == 0:
+                    break
+                yield chunk
+
+    def in_range(self, rows, timestamp_index):
+        for row in rows:
+            timestamp = datetime.datetime.fromisoformat(row[timestamp_index])
+            if self.end is not None and timestamp > self.end:
+                break
+            if self.start is None or timestamp >= self.start:
+                yield row
+
+    def binary_chunks(self):
+        import numpy
+        _, records = map_binary_trace(self.filename)
+        if self.start is not None or self.end is not None:
+            timestamps = records[:, self.schema['columns'].index('timestamp')]
+            first = 0 if self.start is None else numpy.searchsorted(timestamps, timestamp_to_seconds(self.start))
+            last = len(records) if self.end is None else numpy.searchsorted(timestamps,
+                                                                            timestamp_to_seconds(self.end), 'right')
+            records = records[first:last]
+        constants = list(self.schema['constants'].values())
+        converters = []
+        for col in self.schema['columns']:
+            if col == 'timestamp':
+                converters.append(lambda x: str(EPOCH + datetime.timedelta(seconds=x)))
+            elif col in self.schema['categories']:
+                categories = self.schema['categories'][col]
+                converters.append(lambda x, categories=categories: '' if x != x else categories[int(x)])
+            else:
+                converters.append(None)
+        for start in range(0, len(records), self.chunk_size):
+            chunk = []
+            for record in records[start:start+self.chunk_size].tolist():
+                for i, convert in enumerate(converters):
+                    if convert is not None:
+                        record[i] = convert(record[i])
+                chunk.append(constants + record)
+            yield chunk
+
+    def distinct_values(self, column):
+        '''
+        Return the set of the values taken by the given string column.
+        '''
+        if self.schema is not None:
+            if column in self.schema['constants']:
+                return {self.schema['constants'][column]}
+            return set(self.schema['categories'].get(column, []))
+        index = self.header.index(column)
+        return {row[index] for chunk in self.chunks() for row in chunk}
+
+
+def write_binary_dataframe(data, output_file, metadata=None):
+    '''
+    Write the given DataFrame as a binary trace.
+    '''
+    import numpy
+    import pandas
+    constants = {}
+    categories = {}
+    columns = {}
+    for col in data.columns:
+        values = data[col]
+        if col == 'timestamp':
+            values = (pandas.to_datetime(values) - EPOCH).dt.total_seconds()
+        elif not pandas.api.types.is_numeric_dtype(values):
+            uniques = values.dropna().unique()
+            if len(uniques) == 1 and not values.isna().any():
+                constants[col] = str(uniques[0])
+                continue
+            cat = pandas.Categorical(values.astype(str))
+            categories[col] = list(cat.categories)
+            values = cat.codes
+        columns[col] = numpy.asarray(values, dtype='<f8')
+    with open(output_file, 'wb') as f:
+        BinaryTraceWriter(f, list(constants) + list(columns), constants=constants, categories=categories,
+                          metadata=metadata)
+        f.write(numpy.column_stack(list(columns.values())).astype('<f8').tobytes())
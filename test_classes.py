@@ -1,6 +1,11 @@
 from ratatouille.ratatouille import *
+from ratatouille.storage import compressions, detect_compression, open_output_file
+from ratatouille.aggregator import Aggregator, connect_sink
 import os
 import sys
+import time
+import math
+import pytest
 from psutil import cpu_count, net_io_counters
 
 
@@ -24,3 +29,719 @@ def test_monitors():
     temp = Temperature()
     assert len(temp.header) == len(temp.get_values())
     assert len(temp.get_values()) >= cpu_count(logical=False)
+
+
+def test_persistent_file_watcher(tmp_path):
+    for core in range(4):
+        (tmp_path / ('cpu%d' % core)).mkdir()
+        (tmp_path / ('cpu%d' % core) / 'freq').write_text('%d\n' % (core*10))
+    for persistent in [False, True]:
+        mon = FileWatcher(str(tmp_path), 'cpu', 'freq', persistent=persistent)
+        assert mon.get_values() == [0, 10, 20, 30]
+        (tmp_path / 'cpu2' / 'freq').write_text('1234\n')
+        assert mon.get_values() == [0, 10, 1234, 30]
+        (tmp_path / 'cpu2' / 'freq').write_text('20\n')
+        mon.close()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.now += duration
+
+
+def test_scheduler():
+    for catch_up in [False, True]:
+        clock = FakeClock()
+        sched = Scheduler(1, catch_up=catch_up, clock=clock, sleep=clock.sleep)
+        for i in range(1, 5):
+            assert sched.wait() == 0
+            assert clock.now == i
+            clock.now += 0.3  # the time spent collecting does not delay the next deadlines
+        clock.now += 2.5  # deadline 5 is missed by 1.8 seconds
+        assert abs(sched.wait() - 1.8) < 1e-9
+        if catch_up:
+            assert abs(sched.wait() - 0.8) < 1e-9
+            assert sched.wait() == 0
+            assert clock.now == 7
+            assert sched.nb_skipped == 0
+        else:
+            assert sched.wait() == 0
+            assert clock.now == 7
+            assert sched.nb_skipped == 1
+
+
+class SlowWatcher(AbstractWatcher):
+    header = ['slow_0', 'slow_1']
+
+    def __init__(self, duration):
+        self.duration = 0
+        super().__init__()
+        self.duration = duration
+
+    def get_values(self):
+        time.sleep(self.duration)
+        return [1, 2]
+
+
+def test_threaded_collector():
+    watchers = [SlowWatcher(0), SlowWatcher(0.5), SlowWatcher(0.01)]
+    collector = ThreadedCollector(watchers, timeout=0.1)
+    start = time.monotonic()
+    values = collector.collect()
+    assert time.monotonic() - start < 0.4
+    assert values[:2] == [1, 2] and values[4:] == [1, 2]
+    assert all(math.isnan(v) for v in values[2:4])
+    # the slow watcher is still running, it is not called again
+    values = collector.collect()
+    assert all(math.isnan(v) for v in values[2:4])
+    assert collector.pending[1] is not None
+    collector.close()
+
+
+def test_multi_rate_scheduler():
+    clock = FakeClock()
+    sched = MultiRateScheduler([0.1, 0.5, 0.2], clock=clock, sleep=clock.sleep)
+    due = [sched.wait()[1] for _ in range(10)]
+    assert due == [[0], [0, 2], [0], [0, 2], [0, 1], [0, 2], [0], [0, 2], [0], [0, 1, 2]]
+    assert abs(clock.now - 1) < 1e-9
+
+
+def test_binary_trace(tmp_path):
+    import datetime
+    import pandas
+    header = ['hostname', 'timestamp', 'variable', 'value']
+    rows = [['foo', datetime.datetime(2020, 1, 1, 12, 0, i, 1234*(i+1)), 'var_%d' % (i % 3), i*0.5] for i in range(10)]
+    filenames = []
+    for fmt in ['csv', 'binary']:
+        writer = trace_writers[fmt]
+        filenames.append(str(tmp_path / ('trace.%s' % fmt)))
+        with open(filenames[-1], writer.file_mode) as f:
+            writer = writer(f, header, constants={'hostname': 'foo'},
+                            categories={'variable': ['var_0', 'var_1', 'var_2']})
+            writer.writerow(rows[0])
+            writer.writerows(rows[1:])
+    csv_data, bin_data = [read_trace(filename) for filename in filenames]
+    assert list(csv_data.columns) == list(bin_data.columns) == header
+    assert (bin_data.hostname == csv_data.hostname).all()
+    assert (bin_data.variable == csv_data.variable).all()
+    assert (bin_data.value == csv_data.value).all()
+    # same timestamps, up to the float64 precision
+    diff = (bin_data.timestamp - pandas.to_datetime(csv_data.timestamp)).abs()
+    assert diff.max() < pandas.Timedelta(microseconds=1)
+    merged = str(tmp_path / 'merged')
+    merge_files(filenames, merged, output_format='binary')
+    merged = read_trace(merged)
+    assert len(merged) == 20
+    assert list(merged.variable) == [var for var in csv_data.variable for _ in range(2)]
+
+
+def test_compressed_trace(tmp_path):
+    import datetime
+    header = ['hostname', 'timestamp', 'cpu_load', 'frequency_core_0']
+    start = datetime.datetime(2020, 1, 1, 12, 0, 0, 1234)
+    rows = [['foo', start + datetime.timedelta(seconds=i), i*0.5, 2e9 if i < 50 else 3e9] for i in range(100)]
+    rows[10][2] = None
+    rows[20][3] = ''
+    expected = read_trace(write_plain_csv(tmp_path, rows, header))
+    for compression in [None] + list(compressions):
+        for fmt in ['csv', 'csv_delta']:
+            filename = str(tmp_path / ('trace_%s_%s' % (compression, fmt)))
+            try:
+                f = open_output_file(filename, fmt, compression)
+            except ImportError:
+                continue
+            with f:
+                writer = trace_writers[fmt](f, header)
+                writer.writerow(rows[0])
+                writer.writerows(rows[1:])
+                writer.close()
+            assert detect_compression(filename) == compression
+            assert TraceReader(filename).delta == (fmt == 'csv_delta')
+            assert read_trace(filename).equals(expected)
+            assert read_trace(filename, ['frequency_core_0'], start=rows[40][1]).equals(
+                expected[['timestamp', 'frequency_core_0']][40:].reset_index(drop=True))
+            merged = str(tmp_path / 'merged.csv')
+            merge_files([filename], merged)
+            assert read_trace(merged).equals(expected)
+    assert (tmp_path / 'trace_None_csv_delta').stat().st_size < (tmp_path / 'trace_None_csv').stat().st_size
+
+
+def write_plain_csv(tmp_path, rows, header):
+    filename = str(tmp_path / 'plain.csv')
+    with open(filename, 'w') as f:
+        writer = trace_writers['csv'](f, header)
+        writer.writerows(rows)
+        writer.close()
+    return filename
+
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+        self.nb_flush = 0
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+
+    def flush(self):
+        self.nb_flush += 1
+
+    def close(self):
+        pass
+
+
+def test_buffered_writer():
+    for background in [False, True]:
+        writer = ListWriter()
+        buffered = BufferedTraceWriter(writer, flush_rows=3, background=background)
+        buffered.writerow([0])
+        buffered.writerows([[1], [2], [3]])
+        buffered.writerow([4])
+        if background:
+            time.sleep(0.1)
+        assert writer.rows == [[0], [1], [2], [3]]
+        buffered.close()
+        assert writer.rows == [[i] for i in range(5)]
+        assert writer.nb_flush == 2
+    writer = ListWriter()
+    buffered = BufferedTraceWriter(writer, flush_rows=None, flush_interval=0.05)
+    buffered.writerow([0])
+    assert writer.rows == []
+    time.sleep(0.06)
+    buffered.writerow([1])
+    assert writer.rows == [[0], [1]]
+
+
+def test_merge(tmp_path):
+    import pandas
+    filenames = []
+    for i in range(3):
+        filenames.append(str(tmp_path / ('trace_%d.csv' % i)))
+        with open(filenames[-1], 'w') as f:
+            f.write('hostname,timestamp,x,y_%d\n' % i)
+            for j in range(10):
+                f.write('host_%d,2020-01-01 00:00:%02d.%06d,%d,%d\n' % (i, j, i, j, i*10+j))
+    for jobs in [1, 2]:
+        output = str(tmp_path / 'merged.csv')
+        merge_files(filenames, output, jobs=jobs)
+        data = pandas.read_csv(output)
+        assert list(data.columns) == ['hostname', 'timestamp', 'x', 'y_0', 'y_1', 'y_2']
+        assert list(data.timestamp) == sorted(data.timestamp)
+        assert list(data.hostname) == ['host_%d' % i for _ in range(10) for i in range(3)]
+        assert list(data.y_1.dropna()) == list(range(10, 20))
+    # a long trace (e.g. collected with several rates) merged with a wide one
+    with open(filenames[1], 'w') as f:
+        f.write('hostname,timestamp,variable,value\n')
+        for j in range(10):
+            f.write('host_1,2020-01-01 00:00:%02d.500000,cpu_load,%d\n' % (j, j))
+    output = str(tmp_path / 'merged.bin')
+    merge_files(filenames[:2], output, output_format='binary')
+    data = read_trace(output)
+    assert len(data) == 20 and list(data.variable.dropna().unique()) == ['cpu_load']
+    assert data.variable.isna().sum() == 10 and list(data.value.dropna()) == list(range(10))
+    rows = [row for chunk in TraceReader(output).chunks() for row in chunk]
+    assert [row[data.columns.get_loc('variable')] for row in rows[:2]] == ['', 'cpu_load']
+
+
+def test_aggregator(tmp_path):
+    import asyncio
+    import datetime
+    import threading
+    import pandas
+    output = str(tmp_path / 'aggregated.csv')
+    with open(output, 'w') as f:
+        aggregator = Aggregator(f)
+        ready = threading.Event()
+        thread = threading.Thread(target=asyncio.run, args=(aggregator.serve('127.0.0.1', 0, ready=ready),))
+        thread.start()
+        ready.wait()
+        nb_collectors, nb_rows = 50, 20
+        start = datetime.datetime(2020, 1, 1)
+        sinks = []
+        for i in range(nb_collectors):
+            sink = connect_sink('tcp://%s:%d' % aggregator.address)
+            writer = trace_writers['binary'](sink, ['hostname', 'timestamp', 'x', 'y'],
+                                             constants={'hostname': 'host_%d' % i})
+            sink.flush()
+            sinks.append((sink, writer))
+        while len(aggregator.sources) < nb_collectors:
+            time.sleep(0.01)
+        for j in range(0, nb_rows, 5):
+            for i, (sink, writer) in enumerate(sinks):
+                writer.writerows([['host_%d' % i, start + datetime.timedelta(seconds=k, microseconds=i), k, i]
+                                  for k in range(j, j+5)])
+                writer.flush()
+        for sink, _ in sinks:
+            sink.close()
+        # the rows are written once all the collectors are disconnected
+        while aggregator.nb_rows < nb_collectors*nb_rows*2 or len(aggregator.pending) > 0:
+            time.sleep(0.01)
+        aggregator.stop()
+        thread.join()
+    data = pandas.read_csv(output)
+    assert list(data.columns) == ['hostname', 'timestamp', 'variable', 'value']
+    assert len(data) == nb_collectors*nb_rows*2
+    timestamps = [datetime.datetime.fromisoformat(timestamp) for timestamp in data.timestamp]
+    assert timestamps == sorted(timestamps)
+    assert aggregator.nb_collectors == nb_collectors and aggregator.nb_late_rows == 0
+    host = data[data.hostname == 'host_7']
+    assert list(host[host.variable == 'x'].value) == list(range(nb_rows))
+    assert set(host[host.variable == 'y'].value) == {7}
+
+
+def test_downsample():
+    import numpy
+    import pandas
+    timestamps = pandas.date_range('2020-01-01', periods=1000, freq='1s')
+    timestamps = timestamps[(numpy.arange(1000) < 400) | (numpy.arange(1000) >= 500)]
+    segments = Drawer.find_segments(timestamps.values)
+    assert list(segments) == [0]*400 + [1]*500
+    data = pandas.DataFrame({'timestamp': timestamps, 'segment': segments, 'x': numpy.arange(900)})
+    means, mins, maxs = Drawer.downsample(data, 10)
+    # the bucket in the gap is empty
+    assert list(means.segment) == [0]*4 + [1]*5
+    assert mins.x.min() == 0 and maxs.x.max() == 899
+    assert (mins.x <= means.x).all() and (means.x <= maxs.x).all()
+    assert list(means.columns) == list(data.columns)
+    # the buckets span 99.9 seconds, the first one holding the first 100 rows
+    assert means.timestamp.iloc[0] == timestamps[0] + pandas.Timedelta(seconds=49.5)
+    assert (means.timestamp == mins.timestamp).all() and means.timestamp.is_monotonic_increasing
+
+
+def test_plot_aggregated(tmp_path):
+    import pandas
+    pytest.importorskip('plotnine')
+    filename = str(tmp_path / 'trace.csv')
+    pandas.DataFrame({
+        'hostname': 'foo',
+        'timestamp': pandas.date_range('2020-01-01', periods=1000, freq='1s').astype(str),
+        'x': range(1000),
+    }).to_csv(filename, index=False)
+    plot = Drawer(filename).create_plot(['x'], max_points=50)
+    assert len(plot.data) == 50 and plot.data.timestamp.notna().all()
+    assert (plot.data.ymin <= plot.data.value).all() and (plot.data.value <= plot.data.ymax).all()
+    plot.draw()
+
+
+def test_lazy_loading(tmp_path):
+    import pandas
+    filename = str(tmp_path / 'trace.csv')
+    data = pandas.DataFrame({
+        'hostname': 'foo',
+        'timestamp': pandas.date_range('2020-01-01', periods=100, freq='1min').astype(str),
+        'x': range(100),
+        'y': range(100, 200),
+    })
+    data.to_csv(filename, index=False)
+    drawer = Drawer(filename, columns=['x'], cache=True)
+    assert list(drawer.data.columns) == ['timestamp', 'x']
+    assert os.path.isfile(filename + '.ratcache')
+    drawer = Drawer(filename, columns=['y'], start='2020-01-01 00:10', end='2020-01-01 00:19', cache=True)
+    assert list(drawer.data.y) == list(range(110, 120))
+    assert list(read_trace(filename + '.ratcache').columns) == ['timestamp', 'x', 'y']
+    # the cache is outdated when the file changes
+    data['x'] *= 2
+    data.to_csv(filename, index=False)
+    drawer = Drawer(filename, columns=['x'], cache=True)
+    assert list(drawer.data.x) == list(range(0, 200, 2))
+
+
+def test_instrumentation(tmp_path):
+    hist = LatencyHistogram()
+    for i in range(1, 101):
+        hist.record(i * 1e-3)
+    assert hist.count == 100 and hist.max == 0.1
+    assert abs(hist.mean - 0.0505) < 1e-9
+    assert 0.05 <= hist.quantile(0.5) < 0.05 * 1.19
+    assert 0.099 <= hist.quantile(0.99) <= 0.1
+    for core in range(4):
+        (tmp_path / ('cpu%d' % core)).mkdir()
+        (tmp_path / ('cpu%d' % core) / 'freq').write_text('42\n')
+    for persistent, files_opened in [(False, 4), (True, 0)]:
+        mon = FileWatcher(str(tmp_path), 'cpu', 'freq', persistent=persistent)
+        mon.enable_instrumentation()
+        for _ in range(10):
+            mon.sample()
+        summary = mon.instrumentation.summary()
+        assert summary['calls'] == 10
+        assert summary['files_opened'] == files_opened
+        if not math.isnan(summary['read_syscalls']):
+            assert summary['read_syscalls'] >= 4
+        mon.close()
+
+
+def make_hwmon(root, name, sensors, kind='temp'):
+    root.mkdir(parents=True)
+    (root / 'name').write_text(name + '\n')
+    for i, (label, value) in enumerate(sensors, start=1):
+        (root / ('%s%d_input' % (kind, i))).write_text('%d\n' % value)
+        if label is not None:
+            (root / ('%s%d_label' % (kind, i))).write_text(label + '\n')
+
+
+def test_hwmon_plan(tmp_path):
+    make_hwmon(tmp_path / 'hwmon0', 'acpitz', [(None, 27800)])
+    make_hwmon(tmp_path / 'hwmon1', 'coretemp', [('Package id 0', 50000), ('Core 0', 51000), ('Core 1', 52000)])
+    make_hwmon(tmp_path / 'hwmon2', 'coretemp', [('Package id 1', 60000), ('Core 0', 61000), ('Core 1', 62000)])
+    make_hwmon(tmp_path / 'hwmon3', 'dell_smm', [('Processor Fan', 2400), ('Other Fan', 1200)], kind='fan')
+    for persistent in [False, True]:
+        temp = Temperature(persistent=persistent, hwmon_root=str(tmp_path))
+        assert temp.header == ['temperature_core_0', 'temperature_core_1', 'temperature_core_2', 'temperature_core_3',
+                               'temperature_cpu_0', 'temperature_cpu_1', 'temperature_acpitz']
+        assert temp.get_values() == [51, 61, 52, 62, 50, 60, 27.8]
+        (tmp_path / 'hwmon2' / 'temp3_input').write_text('70000\n')
+        assert temp.get_values()[3] == 70
+        (tmp_path / 'hwmon2' / 'temp3_input').write_text('62000\n')
+        temp.close()
+        fans = FanSpeed(persistent=persistent, hwmon_root=str(tmp_path))
+        assert fans.header == ['speed_dell_smm_Processor_Fan', 'speed_dell_smm_Other_Fan']
+        assert fans.get_values() == [2400, 1200]
+        fans.close()
+
+
+def write_proc(root, cpu, ctxt, mem_available, nics):
+    (root / 'net').mkdir(exist_ok=True)
+    (root / 'stat').write_text('cpu  %s\ncpu0 %s\nintr 1000 5 6\nctxt %d\nbtime 1\nsoftirq 500 1 2\n' % (
+        ' '.join(str(v) for v in cpu), ' '.join(str(v) for v in cpu), ctxt))
+    (root / 'meminfo').write_text('MemTotal:       1000 kB\nMemFree:         100 kB\nMemAvailable:    %d kB\n' %
+                                  mem_available)
+    lines = ['Inter-|   Receive', ' face |bytes    packets']
+    for nic, (recv, sent) in nics.items():
+        lines.append('%6s: %d 1 0 0 0 0 0 0 %d 2 0 0 0 0 0 0' % (nic, recv, sent))
+    (root / 'net' / 'dev').write_text('\n'.join(lines) + '\n')
+
+
+def test_proc_backend(tmp_path):
+    interfaces = list(net_io_counters(pernic=True))
+    write_proc(tmp_path, [100, 0, 100, 700, 100, 0, 0, 0, 0, 0], 42, 250, {nic: (0, 0) for nic in interfaces})
+    proc = ProcFS(str(tmp_path))
+    load, stats, mem, net = CPULoad(proc=proc), CPUStats(proc=proc), MemoryUsage(proc=proc), Network(proc=proc)
+    assert all(watcher.proc is proc for watcher in [load, stats, mem, net])
+    assert stats.get_values() == [42, 1000, 500]
+    assert mem.get_values() == [25, 250*1024]
+    # user +100, system +50, idle +300, iowait +50, guest +20 (already in user)
+    write_proc(tmp_path, [200, 0, 150, 1000, 150, 0, 0, 0, 20, 0], 50, 300, {nic: (100, 200) for nic in interfaces})
+    proc.invalidate()
+    assert load.get_values() == [30.0]
+    nb_reads = proc.files['stat'].nb_reads
+    # the file is read once for both watchers
+    assert stats.get_values() == [50, 1000, 500]
+    assert proc.files['stat'].nb_reads == nb_reads
+    # but read again if a watcher asks twice in the same measure
+    stats.get_values()
+    assert proc.files['stat'].nb_reads == nb_reads + 1
+    assert mem.get_values() == [30, 300*1024]
+    speeds = net.get_values()
+    assert len(speeds) == 2*len(interfaces) and all(speed > 0 for speed in speeds)
+    proc.close()
+    # fallback on psutil when /proc is not available
+    load = CPULoad(proc=ProcFS(str(tmp_path / 'nonexistent')))
+    assert load.proc is None
+    assert 0 <= load.get_values()[0] <= 100
+
+
+def test_cpu_core_load(tmp_path):
+    def write_stat(cores):
+        lines = ['cpu  0 0 0 0 0 0 0 0 0 0']
+        lines.extend('cpu%d %s 0 0' % (i, ' '.join(str(v) for v in core)) for i, core in enumerate(cores))
+        (tmp_path / 'stat').write_text('\n'.join(lines) + '\nintr 1 0\nctxt 1\nsoftirq 1 0\n')
+    write_stat([[0]*8, [0]*8, [0]*8])
+    proc = ProcFS(str(tmp_path))
+    load = CPUCoreLoad(proc=proc)
+    assert load.header == ['%s_load_core_%d' % (kind, i) for kind in ['user', 'system', 'iowait', 'irq']
+                           for i in range(3)]
+    assert all(math.isnan(val) for val in load.first_values)
+    # user, nice, system, idle, iowait, irq, softirq, steal
+    write_stat([[10, 10, 20, 40, 10, 5, 5, 0], [0, 0, 0, 100, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0, 0, 0]])
+    proc.invalidate()
+    values = load.get_values()
+    assert values[0::3] == [20, 20, 10, 10]
+    assert values[1::3] == [0, 0, 0, 0]
+    # no time elapsed on the third core
+    assert all(math.isnan(val) for val in values[2::3])
+    # an offline core
+    write_stat([[0]*8, [0]*8])
+    proc.invalidate()
+    assert all(math.isnan(val) for val in load.get_values())
+
+
+def test_counter_rate():
+    clock = FakeClock()
+    rates = CounterRate(ranges=[1000, None, 1000], scale=0.5, clock=clock)
+    assert all(math.isnan(rate) for rate in rates.update([100, 100, 100]))
+    clock.sleep(2)
+    assert rates.update([900, 300, 900]) == [200, 50, 200]
+    clock.sleep(2)
+    # wraparound of the first counter, reset of the two others
+    rate, *others = rates.update([100, 200, 800])
+    assert rate == 50
+    assert all(math.isnan(rate) for rate in others)
+    clock.sleep(1)
+    assert rates.update([100, 200, 800]) == [0, 0, 0]
+    # no time elapsed
+    assert all(math.isnan(rate) for rate in rates.update([200, 300, 900]))
+    # a wraparound over a long interval, accepted for a counter of bounded rate (i.e. 300 per second at most)
+    rates = CounterRate(ranges=[1000, 1000, 1000], clock=clock, max_rates=[float('inf'), 300, None])
+    rates.update([100, 100, 100])
+    clock.sleep(3)
+    *rates_, default = rates.update([0, 0, 0])
+    assert rates_ == [300, 300] and math.isnan(default)
+    clock.sleep(1)
+    rates.update([500, 500, 500])
+    clock.sleep(2)
+    rate, bounded, default = rates.update([400, 400, 400])
+    assert rate == 450 and math.isnan(bounded) and math.isnan(default)
+
+
+def test_window_summary():
+    import datetime
+    histogram = ValueHistogram()
+    values = [(i - 500) * 0.37 for i in range(1000)] + [float('nan')]
+    for value in values:
+        histogram.record(value)
+    assert histogram.count == 1000 and histogram.min == values[0] and histogram.max == values[-2]
+    for q in [0.01, 0.5, 0.99]:
+        expected = values[int(q*1000) - 1]
+        assert abs(histogram.quantile(q) - expected) <= 0.022*abs(expected) + 0.37
+    summary = WindowSummary(60)
+    start = datetime.datetime(2020, 1, 1, 12, 0, 0)
+    rows = []
+    for i in range(150):
+        timestamp = start + datetime.timedelta(seconds=i)
+        rows.extend(summary.add([['foo', timestamp, 'x', float(i)], ['foo', timestamp, 'y', float('nan')]]))
+    # the two first windows are finished
+    assert len(rows) == 2*2*4
+    assert [row[2] for row in rows[:8]] == WindowSummary.variables(['x', 'y'])
+    assert rows[0][1] == '2020-01-01 12:00:00.000000' and rows[8][1] == '2020-01-01 12:01:00.000000'
+    assert [row[3] for row in rows[:4]] == [0, 29.5, 59, 59]
+    assert all(math.isnan(row[3]) for row in rows[4:8])
+    rows = summary.flush()
+    assert rows[0][1] == '2020-01-01 12:02:00.000000'
+    assert [row[3] for row in rows[:3]] == [120, 134.5, 149]
+    assert summary.flush() == []
+
+
+def test_discovery_cache(tmp_path):
+    import ratatouille.ratatouille as rat
+    make_hwmon(tmp_path / 'hwmon0', 'coretemp', [('Package id 0', 50000), ('Core 0', 51000)])
+    cache_file = str(tmp_path / 'cache' / 'discovery.json')
+    try:
+        enable_discovery_cache(cache_file)
+        temp = Temperature(hwmon_root=str(tmp_path))
+        rat.discovery_cache.save()
+        # the sensors are not looked for again
+        make_hwmon(tmp_path / 'hwmon1', 'coretemp', [('Package id 1', 60000), ('Core 0', 61000)])
+        enable_discovery_cache(cache_file)
+        assert Temperature(hwmon_root=str(tmp_path)).header == temp.header
+        # but they are without the cache
+        rat.discovery_cache = None
+        assert len(Temperature(hwmon_root=str(tmp_path)).header) == 2*len(temp.header)
+    finally:
+        rat.discovery_cache = None
+
+
+def test_sampler():
+    import datetime
+    import signal
+    from ratatouille import Sampler
+    from ratatouille.storage import RingBufferWriter
+    start = datetime.datetime(2020, 1, 1, 12, 0, 0)
+    buffer = RingBufferWriter(3, ['hostname', 'timestamp', 'variable', 'value'], constants={'hostname': 'foo'},
+                              categories={'variable': ['x', 'y']})
+    buffer.writerows([['foo', start, 'x', 1.0], ['foo', start, 'y', 2.0]])
+    records = buffer.to_array()
+    seconds = timestamp_to_seconds(start)
+    assert records.base is buffer.records and records.tolist() == [[seconds, 0, 1], [seconds, 1, 2]]
+    buffer.writerows([['foo', start + datetime.timedelta(seconds=i), 'x', float(i)] for i in range(1, 5)])
+    df = buffer.to_dataframe()
+    assert list(df['value']) == [2, 3, 4] and list(df['variable']) == ['x', 'x', 'x']
+    assert list(df['timestamp']) == [start + datetime.timedelta(seconds=i) for i in range(2, 5)]
+    handler = signal.getsignal(signal.SIGINT)
+    with Sampler(['memory_usage', 'cpu_load'], interval=0.01, capacity=5) as sampler:
+        time.sleep(0.2)
+    assert signal.getsignal(signal.SIGINT) is handler
+    assert sampler.buffer.nb_rows > 5
+    df = sampler.to_dataframe()
+    assert len(df) == 5 and df['timestamp'].is_monotonic_increasing
+    assert list(df.columns) == ['hostname', *sampler.columns]
+    assert 'memory_available' in sampler.columns and not df['memory_available'].isna().any()
+    # the /proc files kept open by the watchers are closed by the stop, even without a start
+    sampler = Sampler(['cpu_core_load'])
+    assert sampler.monitor.watchers[0].proc.files != {}
+    sampler.stop()
+    assert sampler.monitor.watchers[0].proc.files == {}
+
+
+def test_burst_policy():
+    import io
+    import threading
+    header = ['hostname', 'timestamp', 'temperature_cpu_0', 'frequency_core_0', 'frequency_core_1']
+    rule = BurstRule('drop(frequency_core_*) > 1e8')
+    rule.bind(header)
+    assert rule.indices == [3, 4]
+    assert not rule.is_met(['foo', 0, 50, 2e9, 2e9])
+    assert rule.is_met(['foo', 0, 50, 2e9, 1.5e9], previous=['foo', 0, 50, 2e9, 2e9])
+    assert not rule.is_met(['foo', 0, 50, 2e9, 2.5e9], previous=['foo', 0, 50, 2e9, 2e9])
+    for wrong_rule in ['temperature_cpu_0 >= 90', 'temperature_cpu_0 > hot']:
+        with pytest.raises(ValueError):
+            BurstRule(wrong_rule)
+    with pytest.raises(ValueError):
+        BurstRule('power_*>20').bind(header)
+    # the period goes down to the burst interval, stays there for hold rows, then doubles up to the base period
+    policy = BurstPolicy(['temperature_cpu_0>90'], interval=1, hold=2, decay=2)
+    policy.bind(header, 10)
+    now, written = 0, []
+    for temperature in [50, 95, 50, 50, 50, 50, 50, 50, 50]:
+        written.extend(row[1] for row in policy.update(['foo', now, temperature, 2e9, 2e9], now))
+        now += policy.period
+    assert written == [0, 10, 11, 12, 13, 15, 19, 27, 37] and policy.nb_bursts == 1
+    # with a pre-trigger buffer, the last measures before the burst are also written
+    policy = BurstPolicy(['temperature_cpu_0>90'], interval=1, hold=0, decay=10, pre_trigger=3)
+    policy.bind(header, 10)
+    written = []
+    for now in range(30):
+        row = ['foo', now, 95 if now == 25 else 50, 2e9, 2e9]
+        written.extend(row[1] for row in policy.update(row, now))
+        assert policy.period == 1
+    assert written == [0, 10, 20, 22, 23, 24, 25, 26]
+    # adaptive scheduler
+    clock = FakeClock()
+    sched = AdaptiveScheduler(1, clock=clock, sleep=clock.sleep)
+    assert sched.wait() == (0, [0]) and clock.now == 1
+    sched.period = 0.25
+    sched.wait()
+    clock.sleep(1.1)
+    assert sched.wait()[0] == pytest.approx(0.85) and sched.nb_skipped == 3 and sched.next_deadline == 2.5
+    # in a monitor, the rule being always met
+    output = io.StringIO()
+    with pytest.raises(ValueError):
+        Monitor([SlowWatcher(0), SlowWatcher(0)], output, 10, periods=[1, None], burst=BurstPolicy(['slow_0>0']),
+                handle_signals=False)
+    monitor = Monitor([SlowWatcher(0)], output, 10, burst=BurstPolicy(['slow_0>0'], interval=0.01),
+                      handle_signals=False)
+    monitor.watch()
+    assert monitor.scheduler.period == 0.01
+    thread = threading.Thread(target=monitor.start_loop)
+    thread.start()
+    time.sleep(0.2)
+    monitor.stop()
+    thread.join()
+    assert output.getvalue().count('\n') > 5
+
+
+def test_fake_system(tmp_path):
+    from ratatouille.fake import FakeSystem
+    fake = FakeSystem(str(tmp_path), nb_cores=8, nb_packages=2, rapl_domains=('core', 'dram'),
+                      interfaces=('eth0', 'ib0'))
+    watchers = {target: fake.create_watcher(target, persistent=True) for target in fake.targets}
+    assert watchers['cpu_freq'].get_values() == [(2000000 + core)*1000 for core in range(8)]
+    assert sorted(watchers['cpu_power'].header) == ['power_package-0', 'power_package-0_core', 'power_package-0_dram',
+                                                    'power_package-1', 'power_package-1_core', 'power_package-1_dram']
+    assert len(watchers['temperature'].header) == 8 + 2
+    assert len(watchers['cpu_core_load'].header) == 8*4
+    assert watchers['network'].header == ['bytes_sent_eth0', 'bytes_recv_eth0', 'bytes_sent_ib0', 'bytes_recv_ib0']
+    assert all(watcher.proc is fake.proc for target, watcher in watchers.items()
+               if target not in ['cpu_freq', 'cpu_power', 'temperature'])
+    assert watchers['memory_usage'].get_values() == [75.0, 12000000*1024]
+    for watcher in watchers.values():
+        watcher.close()
+    fake.close()
+
+
+def test_time_index(tmp_path):
+    import datetime
+    from ratatouille.storage import CSVTraceWriter, TimeIndexWriter, index_filename, read_time_index
+    from ratatouille.storage import find_start_offset, read_csv_trace, TraceReader
+    start = datetime.datetime(2020, 1, 1, 12, 0, 0)
+    header = ['hostname', 'timestamp', 'value']
+    filenames = []
+    for node in range(2):
+        filename = str(tmp_path / ('node%d.csv' % node))
+        with open(filename, 'w') as f, open(index_filename(filename), 'w', newline='') as index_file:
+            writer = TimeIndexWriter(CSVTraceWriter(f, header), index_file, header, every=100)
+            writer.writerows([['node%d' % node, start + datetime.timedelta(seconds=i), i] for i in range(500)])
+            for i in range(500, 1000):
+                writer.writerow(['node%d' % node, start + datetime.timedelta(seconds=i), i])
+            writer.close()
+        filenames.append(filename)
+    entries = read_time_index(filenames[0])
+    assert [timestamp for timestamp, _ in entries] == [start + datetime.timedelta(seconds=i)
+                                                        for i in range(0, 1000, 100)]
+    window = (start + datetime.timedelta(seconds=450), start + datetime.timedelta(seconds=460))
+    assert find_start_offset(filenames[0], header, window[0]) == entries[4][1]
+    rows = [row for chunk in TraceReader(filenames[0], start=window[0], end=window[1]).chunks() for row in chunk]
+    assert [int(row[2]) for row in rows] == list(range(450, 461))
+    data = read_csv_trace(filenames[0], start=window[0], end=window[1], chunk_size=7)
+    assert list(data['value']) == list(range(450, 461)) and list(data.columns) == header
+    output = str(tmp_path / 'merged.csv')
+    merge_files(filenames, output, start=str(window[0]), end=str(window[1]))
+    merged = read_csv_trace(output)
+    assert list(merged['value']) == [i for i in range(450, 461) for _ in range(2)]
+    # an outdated index is not used
+    with open(filenames[0], 'w') as f:
+        writer = CSVTraceWriter(f, header)
+        writer.writerows([['node0', start + datetime.timedelta(seconds=i), i] for i in range(300, 800)])
+    assert find_start_offset(filenames[0], header, window[0]) is None
+    assert list(read_csv_trace(filenames[0], start=window[0], end=window[1])['value']) == list(range(450, 461))
+
+
+def test_scoped_watchers(tmp_path):
+    import subprocess
+    cgroup = tmp_path / 'job.slice'
+    cgroup.mkdir()
+    (cgroup / 'cpu.stat').write_text('usage_usec 1000000\nuser_usec 800000\nsystem_usec 200000\n')
+    (cgroup / 'memory.current').write_text('4096\n')
+    (cgroup / 'io.stat').write_text('8:0 rbytes=1000 wbytes=0 rios=1 wios=0\n')
+    for persistent in [False, True]:
+        watcher = CgroupWatcher('/job.slice', persistent=persistent, root=str(tmp_path))
+        clock = FakeClock()
+        watcher.rates.clock = clock
+        watcher.get_values()
+        clock.sleep(2)
+        (cgroup / 'cpu.stat').write_text('usage_usec 2000000\nuser_usec 1500000\nsystem_usec 500000\n')
+        (cgroup / 'io.stat').write_text('8:0 rbytes=5000 wbytes=2000 rios=5 wios=2\n8:16 rbytes=1000 wbytes=0 rios=1 '
+                                        'wios=0\n')
+        values = watcher.get_values()
+        assert values[:3] == [50, 35, 15] and math.isnan(values[3]) and values[4:] == [4096, 2500, 1000, 2.5, 1]
+        watcher.close()
+        (cgroup / 'cpu.stat').write_text('usage_usec 1000000\nuser_usec 800000\nsystem_usec 200000\n')
+        (cgroup / 'io.stat').write_text('8:0 rbytes=1000 wbytes=0 rios=1 wios=0\n')
+    with pytest.raises(RatatouillePortabilityError):
+        CgroupWatcher('/missing.slice', root=str(tmp_path))
+    # the children created after the watcher are found, the child waiting for a line on its stdin before each step
+    # and writing one on its stdout after it
+    script = ('import subprocess, sys\n'
+              'sys.stdin.readline(); sleep = subprocess.Popen(["sleep", "60"]); print(flush=True)\n'
+              'sys.stdin.readline(); sleep.kill(); sleep.wait(); print(flush=True)\n'
+              'sys.stdin.readline()\n')
+    process = subprocess.Popen([sys.executable, '-c', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+
+    def step():
+        process.stdin.write('\n')
+        process.stdin.flush()
+        process.stdout.readline()
+    tree = ProcessTree(process.pid)
+    assert tree.first_values[2] == 1
+    step()
+    assert tree.get_values()[2] == 2
+    step()
+    values = tree.get_values()
+    assert values[2] == 1 and values[0] >= 0
+    step()
+    process.wait()
+    assert tree.get_values()[2] == 0
+    # by default, the tree of the current process, which can then follow another process
+    tree = ProcessTree()
+    assert tree.root.pid == os.getpid()
+    process = subprocess.Popen([sys.executable, '-c', 'input()'], stdin=subprocess.PIPE)
+    tree.set_root(process.pid)
+    assert tree.get_values()[2] == 1
+    process.communicate(b'\n')
+    assert 'cgroup' in monitor_classes and monitor_classes['process_tree'] is ProcessTree
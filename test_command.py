@@ -22,3 +22,35 @@ def test_collect(period=2, run_time=5, filename='/tmp/test.csv'):
     with open(filename) as f:
         lines = f.readlines()
     assert len(lines) >= math.ceil(run_time/period)
+
+
+def test_run(period=0.5, filename='/tmp/test_run.csv'):
+    start = time.time()
+    proc = run(['ratatouille', 'run', '-t', str(period), '--targets', 'cpu_load,memory_usage', filename, '--',
+                'sh', '-c', 'sleep 1; exit 3'])
+    assert proc.returncode == 3
+    assert time.time() - start < 1 + 2*period + 3
+    with open(filename) as f:
+        header = f.readline().strip().split(',')
+        rows = [dict(zip(header, line.strip().split(','))) for line in f]
+    assert header[-2:] == ['child_start', 'child_exit']
+    # a baseline measure before the start of the command, and a last one after its exit
+    assert rows[0]['child_start'] == 'nan'
+    assert rows[-1]['child_exit'] != 'nan'
+    assert all(row['child_exit'] == 'nan' for row in rows[:-1])
+    assert len(rows) >= 1/period + 2
+
+
+def test_summary(window=0.5, run_time=3, filename='/tmp/test_summary.csv'):
+    import csv
+    import datetime
+    proc = Popen(['ratatouille', 'collect', '-t', '0.1', '--summary', str(window), 'cpu_load', filename])
+    time.sleep(run_time)
+    proc.send_signal(signal.SIGINT)
+    assert proc.wait() == 0
+    with open(filename) as f:
+        rows = list(csv.DictReader(f))
+    # the windows starting on a whole second have the same format as the others
+    timestamps = sorted({datetime.datetime.strptime(row['timestamp'], '%Y-%m-%d %H:%M:%S.%f') for row in rows})
+    assert len(timestamps) >= run_time/window - 2
+    assert {timestamp.microsecond for timestamp in timestamps} == {0, 500000}
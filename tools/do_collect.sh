@@ -15,11 +15,5 @@ timestep=$1
 output_file=$2
 command=$3
 
-python -m ratatouille collect -t ${timestep} all ${output_file} &
-rata_pid=$!
-sleep ${timestep}
-
-eval ${command}
-
-sleep ${timestep}
-kill -2 ${rata_pid}
+# the first measure is taken before the command starts and the last one right after its exit
+python -m ratatouille run -t ${timestep} ${output_file} -- sh -c "${command}"